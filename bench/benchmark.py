@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+"""
+Runs mks_checkpoints_to_git.py against bench/fake_si.py for a project made by
+generate_project.py and reports checkpoints/s, MB/s sent to git fast-import
+and the peak RSS. Arguments after "--" are passed to the conversion.
+
+    python generate_project.py project.json --checkpoints 500
+    python benchmark.py project.json --latency 0.05 -- --sandboxes 4
+
+Only for POSIX systems, the fake si is started by a shell script.
+"""
+
+import os, sys, re, json, time, shutil, tempfile, argparse, subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(os.path.dirname(bench_dir), "mks_checkpoints_to_git.py")
+date_format = "%Y-%m-%d %H:%M:%S"
+
+
+def prepare(work_dir: str, project_file: str) -> dict:
+    """
+    Creates the git repository and the si command, returns the environment of the conversion
+    """
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    si = os.path.join(bin_dir, "si")
+    with open(si, "w") as f:
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(bench_dir, "fake_si.py")))
+    os.chmod(si, 0o755)
+    os.makedirs(os.path.join(work_dir, "repo"))
+    subprocess.run(["git", "init", "-q", "-b", "main"], cwd=os.path.join(work_dir, "repo"), check=True)
+    return dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"], FAKE_SI_PROJECT=os.path.abspath(project_file), FAKE_SI_DATE_FORMAT=date_format)
+
+def run(work_dir: str, env: dict, project: str, conversion_args) -> dict:
+    repo = os.path.join(work_dir, "repo")
+    log_file = os.path.join(work_dir, "conversion.log")
+    start = time.perf_counter()
+    with open(log_file, "wb") as log:
+        process = subprocess.Popen([ sys.executable, script, project, "--date-format", date_format ] + conversion_args, cwd=repo, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    with open(log_file, "r", errors="replace") as f:
+        output = f.read()
+    sent = re.findall(r"([0-9.]+) MB sent to git fast-import", output)
+    index_file = os.path.join(repo, ".git", "integrity2git", "revisions")
+    return {
+        "exitcode": os.waitstatus_to_exitcode(status),
+        "seconds": seconds,
+        "checkpoints": sum(1 for line in open(index_file)) if os.path.isfile(index_file) else 0,
+        "mb_sent": float(sent[-1]) if sent else 0.0,
+        "peak_rss_mb": usage.ru_maxrss / 1024, # of the largest process: the conversion, git fast-import or si
+        "log": log_file,
+    }
+
+
+parser = argparse.ArgumentParser(description="Benchmark mks_checkpoints_to_git.py with a fake si")
+parser.add_argument("project",      help="project made by generate_project.py")
+parser.add_argument("--latency",    help="latency of each si command in seconds, or <command>=<seconds>,...", default="")
+parser.add_argument("--work-dir",   help="directory for the repository and the log, it is kept (default: temporary)")
+parser.add_argument("--json",       help="print the result as JSON", action="store_true")
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    conversion_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+    with open(args.project, "r") as f:
+        project = json.load(f)["project"]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="integrity2git-bench-")
+    env = prepare(work_dir, args.project)
+    env["FAKE_SI_LATENCY"] = args.latency
+    result = run(work_dir, env, project, conversion_args)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        del result["log"]
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print("%d checkpoints in %0.1fs: %0.2f checkpoints/s, %0.1f MB sent to git fast-import: %0.1f MB/s, peak RSS %0.0f MB" % (
+            result["checkpoints"], result["seconds"], result["checkpoints"] / result["seconds"], result["mb_sent"], result["mb_sent"] / result["seconds"], result["peak_rss_mb"]))
+    if result["exitcode"] != 0:
+        print("The conversion failed, see " + result["log"] if "log" in result else "The conversion failed, use --work-dir to keep the log", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+"""
+Simulates the parts of the MKS/PTC Integrity command line client `si` that
+mks_checkpoints_to_git.py uses, so the conversion can be run without an
+Integrity server. The simulated project is read from the JSON file named by
+the environment variable FAKE_SI_PROJECT, e.g. made by generate_project.py:
+
+    { "project": "/path/project.pj", "seed": 1, "projects": [ ...further projects
+      with the same content... ],
+      "devpaths": [ { "name": "...", "ancestor": "1.2" } ],
+      "revisions": [ { "number": "1.1", "parent": null, "devpath": null,
+                       "author": "...", "seconds": 1500000000, "labels": [],
+                       "description": "...",
+                       "changes": { "path": [version, size] or null },
+                       "subprojects": { "path": [ shared project, revision ] or null } } ],
+      "shared": { "shared project": { "project": ..., "seed": ..., "revisions": ... } } }
+
+The content of a file version is generated from the seed. Further settings:
+
+    FAKE_SI_LATENCY      "<seconds>" or "<command>=<seconds>,..." per command
+    FAKE_SI_FAIL         "<command>=<n>,...": the first n calls fail
+    FAKE_SI_HANG         "<command>=<n>,...": the first n calls never return
+    FAKE_SI_DATE_FORMAT  date format of viewprojecthistory (default "%x %X")
+
+Each call is appended to the file FAKE_SI_PROJECT + ".calls".
+"""
+
+import os, sys, io, json, random, shutil, time, shlex, traceback
+from contextlib import redirect_stdout
+from datetime import datetime
+
+
+def load_project():
+    with open(os.environ["FAKE_SI_PROJECT"], "r") as f:
+        return json.load(f)
+
+def setting(variable: str, command: str) -> float:
+    """
+    Returns the value for the command from a setting "<value>" or "<command>=<value>,..."
+    """
+    value = os.environ.get(variable, "")
+    if not value: return 0
+    if "=" not in value: return float(value)
+    for entry in value.split(","):
+        name, number = entry.split("=")
+        if name.strip() == command: return float(number)
+    return 0
+
+def record_call(command: str, mode: str) -> int:
+    """
+    Appends the call to the calls file and returns how often the command was called before
+    """
+    calls = os.environ["FAKE_SI_PROJECT"] + ".calls"
+    before = 0
+    if os.path.isfile(calls):
+        with open(calls, "r") as f:
+            before = sum(1 for line in f if line.split()[1] == command)
+    with open(calls, "a") as f:
+        f.write("%s %s\n" % (mode, command))
+    return before
+
+def parse_options(argv):
+    options, positional = {}, []
+    for arg in argv:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            options[key] = value.strip('"')
+        elif arg.startswith("-"):
+            options[arg[1:]] = ""
+        else:
+            positional.append(arg.strip('"'))
+    return options, positional
+
+
+class Project:
+    def __init__(self, root, path: str=None):
+        self.root = root
+        self.data = root.get("shared", {}).get(path, root)
+        self.revisions = { r["number"]: r for r in self.data["revisions"] }
+
+    def state(self, number: str, key: str):
+        """
+        Returns the entries of the key ("changes" or "subprojects") as they are in the checkpoint
+        """
+        chain = []
+        while number:
+            revision = self.revisions[number]
+            chain.append(revision)
+            number = revision["parent"]
+        entries = {}
+        for revision in reversed(chain):
+            for path, entry in revision.get(key, {}).items():
+                if entry is None: entries.pop(path, None)
+                else: entries[path] = entry
+        return entries
+
+    def files(self, number: str):
+        """
+        Returns path -> [version, size] of the checkpoint
+        """
+        return self.state(number, "changes")
+
+    def walk(self, number: str, prefix: str=""):
+        """
+        Yields ("member", path, Project, path in that project, [version, size]) and
+        ("subproject", path, project, revision) of the checkpoint and its shared subprojects
+        """
+        for path, change in self.files(number).items():
+            yield "member", prefix + path, self, path, change
+        for path, (project, revision) in self.state(number, "subprojects").items():
+            yield "subproject", prefix + path, project, revision
+            yield from Project(self.root, project).walk(revision, prefix + path + "/")
+
+    def tree(self, number: str):
+        """
+        Returns path -> (Project, path in that project, [version, size]) of all files in a sandbox of the checkpoint
+        """
+        return { entry[1]: entry[2:] for entry in self.walk(number) if entry[0] == "member" }
+
+    def write_file(self, filename: str, path: str, change):
+        """
+        Writes deterministic content for the version of a file
+        """
+        version, size = change
+        rnd = random.Random("%d:%s:%d" % (self.data["seed"], path, version))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            for offset in range(0, size, 65536):
+                f.write(rnd.randbytes(min(65536, size - offset)))
+
+
+class Sandbox:
+    """
+    Sandbox state is kept in the project file of the sandbox
+    """
+    def __init__(self, pj: str, root):
+        self.directory = os.path.dirname(pj)
+        self.pj = pj
+        self.root = root
+
+    def load(self):
+        with open(self.pj, "r") as f:
+            return json.load(f)
+
+    def save(self, state):
+        with open(self.pj, "w") as f:
+            json.dump(state, f)
+
+    def create(self, project: Project, number: str):
+        os.makedirs(self.directory, exist_ok=True)
+        for path, (owner, own_path, change) in project.tree(number).items():
+            owner.write_file(os.path.join(self.directory, path), own_path, change)
+        self.save({ "project": project.data["project"], "revision": number, "target": number })
+
+    def resync(self):
+        state = self.load()
+        project = Project(self.root, state["project"])
+        old = project.tree(state["revision"])
+        new = project.tree(state["target"])
+        key = lambda entry: (entry[0].data["project"], entry[1], entry[2])
+        for path in old:
+            if path not in new:
+                os.remove(os.path.join(self.directory, path))
+        for path, entry in new.items():
+            if path not in old or key(old[path]) != key(entry):
+                entry[0].write_file(os.path.join(self.directory, path), entry[1], entry[2])
+        state["revision"] = state["target"]
+        self.save(state)
+
+
+def viewprojecthistory(project: Project, options):
+    devpath = options["rfilter"][len("devpath:"):].strip('"')
+    devpath = None if devpath == ":current" else devpath
+    date_format = os.environ.get("FAKE_SI_DATE_FORMAT", "%x %X")
+    out = [ project.data["project"] ]
+    for revision in reversed(project.data["revisions"]):
+        if revision["devpath"] != devpath: continue
+        date = datetime.fromtimestamp(revision["seconds"]).strftime(date_format)
+        description = revision["description"].split("\n")
+        out.append("\t".join([revision["number"], revision["author"], date, "", "", ",".join(revision["labels"]), description[0]]))
+        out.extend(description[1:])
+    return "\n".join(out) + "\n"
+
+def projectinfo(project: Project, options):
+    out = [ "Development Paths:" ]
+    for devpath in project.data.get("devpaths", []):
+        out.append("    %s (%s)" % (devpath["name"], devpath["ancestor"]))
+    return "\n".join(out) + "\n"
+
+
+def viewproject(project: Project, options):
+    """
+    Members and shared subprojects with the requested fields of type, memberrev, memberarchive and name
+    """
+    prefix = os.path.dirname(project.data["project"])
+    entries = []
+    for entry in project.walk(options["projectRevision"]):
+        if entry[0] == "member":
+            _, path, owner, own_path, (version, size) = entry
+            archive = "%s/%s" % (os.path.dirname(owner.data["project"]), own_path)
+            entries.append({ "type": "member", "memberrev": "1.%d" % version, "memberarchive": archive, "name": "%s/%s" % (prefix, path) })
+        else:
+            _, path, sub_project, revision = entry
+            entries.append({ "type": "shared-build-subproject", "memberrev": revision, "memberarchive": sub_project,
+                             "name": "%s/%s/%s" % (prefix, path, os.path.basename(sub_project)) })
+    fields = options["fields"].split(",")
+    out = [ " ".join([ entry[field] for field in fields ]) for entry in sorted(entries, key=lambda e: e["name"]) ]
+    return "\n".join(out) + "\n"
+
+def projectco(project: Project, options, positional):
+    path = positional[0]
+    owner, own_path, change = project.tree(options["projectRevision"])[path]
+    assert options["revision"] == "1.%d" % change[0], "Wrong member revision"
+    owner.write_file(options["targetFile"], own_path, change)
+
+
+def run(argv, mode: str="process") -> int:
+    if not argv:
+        print("usage: si <command> [options]", file=sys.stderr)
+        return 1
+    command = argv[0]
+    options, positional = parse_options(argv[1:])
+    before = record_call(command, mode)
+    time.sleep(setting("FAKE_SI_LATENCY", command))
+    if before < setting("FAKE_SI_HANG", command):
+        time.sleep(3600)
+    if before < setting("FAKE_SI_FAIL", command):
+        print("Simulated failure of %s" % command)
+        return 1
+    root = load_project()
+    project = Project(root, options.get("project"))
+
+    if command == "connect":
+        return 0
+    if command == "projects":
+        sys.stdout.write("\n".join([ root["project"] ] + root.get("projects", []) + list(root.get("shared", {}))) + "\n")
+        return 0
+    if command == "viewprojecthistory":
+        sys.stdout.write(viewprojecthistory(project, options))
+    elif command == "projectinfo":
+        sys.stdout.write(projectinfo(project, options))
+    elif command == "viewproject":
+        sys.stdout.write(viewproject(project, options))
+    elif command == "projectco":
+        projectco(project, options, positional)
+    elif command == "createsandbox":
+        Sandbox(os.path.join(positional[0], os.path.basename(project.data["project"])), root).create(project, options["projectRevision"])
+    elif command == "retargetsandbox":
+        sandbox = Sandbox(positional[0], root)
+        state = sandbox.load()
+        state["target"] = options["projectRevision"]
+        sandbox.save(state)
+    elif command == "resync":
+        Sandbox(options["sandbox"], root).resync()
+    elif command == "dropsandbox":
+        shutil.rmtree(os.path.dirname(positional[0]), ignore_errors=True)
+    else:
+        print("Unknown command %s" % command, file=sys.stderr)
+        return 1
+    sys.stdout.flush()
+    return 0
+
+
+def serve():
+    """
+    Command server for --si-server: one command per line, output is ended by the terminator and the exit code
+    """
+    for line in sys.stdin:
+        argv = shlex.split(line)
+        if argv and argv[0] == "si": argv = argv[1:]
+        output = io.StringIO()
+        with redirect_stdout(output):
+            try:
+                exitcode = run(argv, "server")
+            except Exception:
+                traceback.print_exc(file=output)
+                exitcode = 1
+        sys.stdout.write(output.getvalue())
+        sys.stdout.write("\x1e%d\n" % exitcode)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--serve"]:
+        serve()
+    else:
+        sys.exit(run(sys.argv[1:]))
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+"""
+Generates a synthetic MKS project for bench/fake_si.py: a main line of
+checkpoints and development paths that branch off from it. Each checkpoint
+modifies a part of the files (churn) and sometimes adds or removes files.
+The file sizes follow a log-normal distribution.
+
+    python generate_project.py project.json --checkpoints 1000 --files 5000
+"""
+
+import sys, json, math, random, argparse
+
+
+def file_size(rnd: random.Random, args) -> int:
+    return min(int(rnd.lognormvariate(math.log(args.size_median), args.size_sigma)), args.size_max)
+
+def file_path(rnd: random.Random, number: int, args) -> str:
+    dirs = [ "dir%d" % rnd.randrange(args.dirs_per_level) for level in range(rnd.randint(1, args.depth)) ]
+    return "/".join(dirs + [ "file%d.%s" % (number, rnd.choice([ "c", "h", "txt", "bin" ])) ])
+
+def change(rnd: random.Random, files: dict, versions: dict, args, next_file: list) -> dict:
+    """
+    Modifies the files of a checkpoint and returns the changes: path -> [version, size] or None if removed.
+    versions holds the last version of each path, a version is never used twice, also not in other devpaths.
+    """
+    changes = {}
+    for path in rnd.sample(sorted(files), min(len(files), int(round(len(files) * args.churn)))):
+        versions[path] += 1
+        files[path] = [ versions[path], file_size(rnd, args) ]
+        changes[path] = files[path]
+    for i in range(int(rnd.random() < args.add_rate)):
+        path = file_path(rnd, next_file[0], args)
+        next_file[0] += 1
+        if path in versions: continue
+        versions[path] = 1
+        files[path] = [ 1, file_size(rnd, args) ]
+        changes[path] = files[path]
+    if files and rnd.random() < args.remove_rate:
+        path = rnd.choice(sorted(files))
+        del files[path]
+        changes[path] = None
+    return changes
+
+def generate(args) -> dict:
+    rnd = random.Random(args.seed)
+    seconds = 1500000000
+    files = {}
+    next_file = [ 0 ]
+    while len(files) < args.files:
+        files[file_path(rnd, next_file[0], args)] = [ 1, file_size(rnd, args) ]
+        next_file[0] += 1
+    versions = { path: 1 for path in files }
+
+    revisions = []
+    states = {}         # number -> files of the checkpoint, only for branch points
+    branch_points = sorted(rnd.sample(range(1, args.checkpoints + 1), min(args.devpaths, args.checkpoints)))
+    for i in range(1, args.checkpoints + 1):
+        changes = dict(files) if i == 1 else change(rnd, files, versions, args, next_file)
+        seconds += rnd.randint(60, 7 * 24 * 3600)
+        number = "1.%d" % i
+        revisions.append({ "number": number, "parent": "1.%d" % (i - 1) if i > 1 else None, "devpath": None,
+                           "author": "user%d" % rnd.randrange(args.authors), "seconds": seconds,
+                           "labels": [ "Label_%d" % i ] if args.label_every and i % args.label_every == 0 else [],
+                           "description": "Checkpoint %d\nwith a second line" % i, "changes": changes })
+        if i in branch_points: states[number] = dict(files)
+
+    devpaths = []
+    branches = {}       # branch point -> number of devpaths that start there
+    for n, i in enumerate(branch_points):
+        ancestor = "1.%d" % i
+        branches[ancestor] = branches.get(ancestor, 0) + 1
+        name = "DevPath %d" % n
+        devpaths.append({ "name": name, "ancestor": ancestor })
+        devpath_files = dict(states[ancestor])
+        parent = ancestor
+        for j in range(1, args.devpath_checkpoints + 1):
+            number = "%s.%d.%d" % (ancestor, branches[ancestor], j)
+            seconds += rnd.randint(60, 3600)
+            revisions.append({ "number": number, "parent": parent, "devpath": name, "author": "user%d" % rnd.randrange(args.authors),
+                               "seconds": seconds, "labels": [], "description": "%s checkpoint %d" % (name, j),
+                               "changes": change(rnd, devpath_files, versions, args, next_file) })
+            parent = number
+    return { "project": args.project, "seed": args.seed, "revisions": revisions, "devpaths": devpaths }
+
+
+parser = argparse.ArgumentParser(description="Generate a synthetic MKS project for fake_si.py")
+parser.add_argument("output",                   help="JSON file for FAKE_SI_PROJECT")
+parser.add_argument("--project",                help="MKS path of the project", default="/bench/project.pj")
+parser.add_argument("--checkpoints",            help="number of checkpoints of the main line", type=int, default=100)
+parser.add_argument("--files",                  help="number of files of the first checkpoint", type=int, default=1000)
+parser.add_argument("--size-median",            help="median file size in bytes", type=int, default=8192)
+parser.add_argument("--size-sigma",             help="sigma of the log-normal file size distribution", type=float, default=1.5)
+parser.add_argument("--size-max",               help="maximum file size in bytes", type=int, default=256*1024*1024)
+parser.add_argument("--churn",                  help="share of the files that are modified by each checkpoint", type=float, default=0.02)
+parser.add_argument("--add-rate",               help="probability that a checkpoint adds a file", type=float, default=0.3)
+parser.add_argument("--remove-rate",            help="probability that a checkpoint removes a file", type=float, default=0.1)
+parser.add_argument("--devpaths",               help="number of development paths", type=int, default=5)
+parser.add_argument("--devpath-checkpoints",    help="number of checkpoints of each development path", type=int, default=10)
+parser.add_argument("--depth",                  help="maximum directory depth", type=int, default=4)
+parser.add_argument("--dirs-per-level",         help="number of directories per level", type=int, default=5)
+parser.add_argument("--authors",                help="number of authors", type=int, default=5)
+parser.add_argument("--label-every",            help="label every n-th checkpoint, 0 for no labels", type=int, default=10)
+parser.add_argument("--seed",                   help="seed of the random numbers", type=int, default=1)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with open(args.output, "w") as f:
+        json.dump(generate(args), f)
@@ -0,0 +1,14 @@
+"""
+Command lines of the scripts of integrity2git, which import it from their directory
+"""
+
+import shlex, platform
+
+
+def split(command: str):
+    """
+    Returns the command line as subprocess takes it: Windows hands the command line to the program as it is,
+    elsewhere it has to be split into arguments
+    """
+    if platform.system() == 'Windows': return command
+    return shlex.split(command)
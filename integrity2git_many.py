@@ -1,14 +1,22 @@
 import os
+import re
 import subprocess
 import time
 import sys
+import json
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from command_line import split
 
 """
 This is a small script around integrity2git.py to call it for many projects.
-This code is neither beautiful nor well tested, but it seems to do the job.
+Several projects are converted at the same time, the largest first. The state of each project is kept in a
+state file, so a second call skips the projects that are done and continues the others.
 """
 
-# File(s) with one MKS project path per line
+# File(s) with one MKS project path per line, optionally followed by a tab and the name of the MKS server
 files = [ "inputfile.txt" ]
 # MKS prefix of all project paths
 prefix = "c:/prefix/"
@@ -16,41 +24,219 @@ prefix = "c:/prefix/"
 encoding = "Windows-1252"
 # Command to the other python script
 conversion_command = r'C:\Python\python C:\integrity2git\mks_checkpoints_to_git.py --date-format "%d.%m.%Y %H:%M:%S" --input-encoding "' + encoding + '"'
+# Additional arguments of the conversion command per MKS server, e.g. '--si-server "python si_command_server.py connect --hostname=..."'
+server_arguments = {}
+# Number of projects that are converted at the same time, in total and per MKS server
+jobs = 4
+jobs_per_server = 2
+# State of all projects, the log files and the history of all projects (shared by the conversions)
+state_file = "integrity2git_many.json"
+log_dir = "logs"
+metadata_cache = "metadata.sqlite"
+# Bare repository with the objects of all converted projects, so identical files are stored and sent only once (None to disable)
+shared_store = None
 
 
+parser = argparse.ArgumentParser(description="Convert many MKS projects to Git")
+parser.add_argument("files",                nargs="*", help="files with one MKS project path per line, optionally followed by a tab and the MKS server", default=files)
+parser.add_argument("--prefix",             help="MKS prefix of all project paths", default=prefix)
+parser.add_argument("--conversion-command", help="command to mks_checkpoints_to_git.py", default=conversion_command)
+parser.add_argument("--jobs",               help="number of projects that are converted at the same time", type=int, default=jobs)
+parser.add_argument("--jobs-per-server",    help="number of projects of the same MKS server that are converted at the same time", type=int, default=jobs_per_server)
+parser.add_argument("--shared-store",       help="bare repository with the objects of all converted projects", default=shared_store)
+args = parser.parse_args()
+
 working_dir = os.getcwd()
+state_file = os.path.join(working_dir, state_file)
+log_dir = os.path.join(working_dir, log_dir)
+metadata_cache = os.path.join(working_dir, metadata_cache)
+shared_store = os.path.join(working_dir, args.shared_store) if args.shared_store else None
+shared_store_lock = threading.Lock()
+
+
+class Job:
+    def __init__(self, project: str, server: str):
+        self.project = project
+        self.server = server
+        self.dir = os.path.join(working_dir, project[len(args.prefix):])   # create directory (removing some prefix)
+        self.name = project[len(args.prefix):].strip("/").replace("/", "_")
+        self.log = os.path.join(log_dir, self.name + ".log")
+        self.revisions = None       # number of revisions in the metadata cache, None if the project was not read yet
+
+    def mks_project(self) -> str:
+        """
+        The project as the conversion stores it in the metadata cache
+        """
+        return self.project if self.project.endswith(".pj") else self.project + "/project.pj"
+
+
+class State:
+    """
+    State file with project -> { status (running, done or failed), exitcode, seconds, converted, revisions, log }
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.projects = {}
+        if os.path.isfile(filename):
+            with open(filename, 'r', encoding="utf-8") as f:
+                self.projects = json.load(f)
+
+    def update(self, project: str, **values):
+        with self.lock:
+            self.projects.setdefault(project, {}).update(values)
+            with open(self.filename + ".tmp", 'w', encoding="utf-8") as f:
+                json.dump(self.projects, f, indent=1)
+            os.replace(self.filename + ".tmp", self.filename)
+
+    def status(self, project: str) -> str:
+        return self.projects.get(project, {}).get("status")
+
 
 def get_projects():
-    projects = []
-    for file in files:
-        projects.extend(open(file, 'r').readlines())
-    projects = set([ p.strip() for p in projects ])
-    return projects
+    projects = {}
+    for file in args.files:
+        for line in open(file, 'r').readlines():
+            if not line.strip(): continue
+            project, _, server = line.rstrip("\r\n").partition("\t")
+            projects[project.strip()] = server.strip()
+    return [ Job(project, server) for project, server in projects.items() ]
 
 def check_project_existance(projects):
-    data = subprocess.check_output("si projects")
+    data = subprocess.check_output(split("si projects"))
     existing_projects = [ p.decode(encoding).strip() for p in data.split(b"\n") ]
-    wrong_projects = [ p for p in projects if p not in existing_projects ]
+    wrong_projects = [ p.project for p in projects if p.project not in existing_projects ]
     if (wrong_projects):
         raise Exception("These projects do not exist: "+ "\n".join(wrong_projects))
 
-def convert_project(projectPath):
-    # create directory (removing some prefix)
-    dir = projectPath[len(prefix):]
-    #if os.path.isdir(dir): return
-    print(f"##### {projectPath} #####", file=sys.stdout, flush=True)
-    print(f"##### {projectPath} #####", file=sys.stderr, flush=True)
-    os.makedirs(dir)
-    os.chdir(dir)
-    # run the conversion
-    subprocess.run("git init")
-    subprocess.run("git checkout -b main --quiet")
-    subprocess.run(conversion_command + ' "' + projectPath + '"')
+def read_revision_counts(projects):
+    """
+    Sets the number of revisions of the projects that are in the metadata cache of an earlier run
+    """
+    if not os.path.isfile(metadata_cache): return
+    db = sqlite3.connect(metadata_cache, timeout=60)
+    counts = dict(db.execute("SELECT project, COUNT(*) FROM revisions GROUP BY project"))
+    db.close()
+    for job in projects:
+        job.revisions = counts.get(job.mks_project())
+
+def count_revisions(projects):
+    """
+    Sets the number of checkpoints on the main line of the projects that are not in the metadata cache, e.g. on the
+    first run. It costs one si command per project and is enough to tell the large projects from the small ones.
+    """
+    def count(job: Job):
+        result = subprocess.run(split('si viewprojecthistory --quiet --rfilter=devpath::current --project="%s"' % job.project), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode != 0: return # stays unknown
+        job.revisions = len([ line for line in result.stdout.decode(encoding).splitlines() if re.match(r"\d+(\.\d+)+\t", line) ])
+    with ThreadPoolExecutor(args.jobs) as executor:
+        list(executor.map(count, [ job for job in projects if job.revisions is None ]))
+
+def schedule(projects):
+    """
+    Orders the projects largest first. Projects whose size is unknown might be large and come first.
+    """
+    return sorted(projects, key=lambda job: -1 if job.revisions is None else -job.revisions)
+
+def converted_revisions(job: Job) -> int:
+    index_file = os.path.join(job.dir, ".git", "integrity2git", "revisions")
+    if not os.path.isfile(index_file): return 0
+    with open(index_file, 'r') as f:
+        return sum(1 for line in f)
+
+def create_shared_store():
+    if not os.path.isdir(shared_store):
+        subprocess.run(["git", "init", "--bare", "--quiet", shared_store], check=True)
+    os.makedirs(os.path.join(shared_store, "integrity2git"), exist_ok=True)
+
+def publish(job: Job, log):
+    """
+    Adds the objects of a converted project to the shared store and its blobs to the blob index of the store,
+    then removes the objects from the project that are in the store now
+    """
+    name = re.sub("[^A-Za-z0-9_.-]", "_", job.name)
+    with shared_store_lock:
+        subprocess.run(["git", "fetch", "--quiet", "--no-tags", os.path.join(job.dir, ".git"), "+refs/heads/*:refs/projects/%s/heads/*" % name, "+refs/tags/*:refs/projects/%s/tags/*" % name],
+                       cwd=shared_store, stdout=log, stderr=subprocess.STDOUT, check=True)
+        subprocess.run(["git", "repack", "-d", "-q"], cwd=shared_store, stdout=log, stderr=subprocess.STDOUT, check=True) # packs small fetches, their objects would stay loose in the project
+    blobs_file = os.path.join(job.dir, ".git", "integrity2git", "blobs")
+    if os.path.isfile(blobs_file):
+        shas = "".join([ line.split()[0] + "\n" for line in open(blobs_file, 'r') if line.strip() ])
+        objects = subprocess.run(["git", "cat-file", "--batch-check"], cwd=shared_store, input=shas.encode("ascii"), stdout=subprocess.PIPE, check=True).stdout.decode("ascii")
+        blobs = "".join([ line.split()[0] + "\n" for line in objects.splitlines() if line.split()[1] == "blob" ])
+        with shared_store_lock:
+            with open(os.path.join(shared_store, "integrity2git", "blobs"), 'a') as f:
+                f.write(blobs)
+    subprocess.run(["git", "repack", "-a", "-d", "-l", "-q"], cwd=job.dir, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+def convert_project(job: Job, state: State):
+    print(f"##### {job.project} #####", file=sys.stdout, flush=True)
+    os.makedirs(job.dir, exist_ok=True)
+    already_converted = converted_revisions(job)
+    start = time.time()
+    state.update(job.project, status="running", log=job.log, started=start)
+    with open(job.log, 'ab') as log:
+        if not os.path.isdir(os.path.join(job.dir, ".git")):
+            subprocess.run(split("git init"), cwd=job.dir, stdout=log, stderr=subprocess.STDOUT)
+            subprocess.run(split("git checkout -b main --quiet"), cwd=job.dir, stdout=log, stderr=subprocess.STDOUT)
+        # run the conversion
+        command = args.conversion_command + ' --metadata-cache "' + metadata_cache + '" ' + server_arguments.get(job.server, "") + ' "' + job.project + '"'
+        if shared_store: command += ' --shared-store "' + shared_store + '"'
+        exitcode = subprocess.run(split(command), cwd=job.dir, stdout=log, stderr=subprocess.STDOUT).returncode
+        if exitcode == 0 and shared_store: publish(job, log)
+    seconds = time.time() - start
+    state.update(job.project, status="done" if exitcode == 0 else "failed", exitcode=exitcode, seconds=seconds, converted=converted_revisions(job) - already_converted)
+    print(f"##### {job.project}: {'done' if exitcode == 0 else 'failed with %d' % exitcode} after {seconds:0.0f}s #####", file=sys.stdout, flush=True)
+
+def run(projects, state: State):
+    """
+    Converts the projects in their order with at most args.jobs conversions at a time and args.jobs_per_server for each MKS server
+    """
+    pending = list(projects)
+    running = {}    # future -> Job
+    busy = {}       # server -> number of running conversions
+    with ThreadPoolExecutor(args.jobs) as executor:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= args.jobs: break
+                if busy.get(job.server, 0) >= args.jobs_per_server: continue
+                pending.remove(job)
+                busy[job.server] = busy.get(job.server, 0) + 1
+                running[executor.submit(convert_project, job, state)] = job
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                busy[job.server] -= 1
+                if future.exception():
+                    print(f"##### {job.project}: {future.exception()} #####", file=sys.stderr, flush=True)
+                    state.update(job.project, status="failed", exitcode=None)
+
+def report(projects, state: State):
+    total_seconds = 0
+    total_converted = 0
+    for job in projects:
+        entry = state.projects.get(job.project, {})
+        seconds = entry.get("seconds", 0)
+        converted = entry.get("converted", 0)
+        total_seconds += seconds
+        total_converted += converted
+        print("%-8s %8.0fs %8d revisions %8.2f revisions/s  %s" % (entry.get("status"), seconds, converted, converted / seconds if seconds else 0, job.project))
+    print("%d of %d projects done, %d revisions in %0.0fs of conversions" % (len([ j for j in projects if state.status(j.project) == "done" ]), len(projects), total_converted, total_seconds))
 
 
 
+os.makedirs(log_dir, exist_ok=True)
+if shared_store: create_shared_store()
+state = State(state_file)
 projects = get_projects()
 check_project_existance(projects)
-for project in projects:
-    os.chdir(working_dir)
-    convert_project(project)
+read_revision_counts(projects)
+for job in projects:
+    if job.revisions is not None: state.update(job.project, revisions=job.revisions)
+todo = [ job for job in projects if state.status(job.project) != "done" ]
+count_revisions(todo)
+todo = schedule(todo)
+print(f"{len(projects) - len(todo)} of {len(projects)} projects are done already", flush=True)
+run(todo, state)
+report(projects, state)
+if any([ state.status(job.project) != "done" for job in projects ]): sys.exit(1)
@@ -20,6 +20,9 @@ def convert_tag_name(name: str):
     else:
         name = name.replace(" ", "_")
     return name
+def convert_submodule_url(project: str, directory: str):
+    # url of a shared subproject in .gitmodules (--submodules), by default the directory it was converted into
+    return directory
 
 
 import os, sys, re, time, platform, shutil
@@ -27,18 +30,52 @@ import subprocess
 import locale
 import argparse
 import tempfile
+import threading
+import queue
+import hashlib
+import json
+import sqlite3
+import random
+import cProfile
+from contextlib import contextmanager
+from collections import deque
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from git import Repo
-from typing import List, Tuple
+from command_line import split
+from typing import List, Tuple, Dict
 
 parser = argparse.ArgumentParser(description="Convert MKS to Git")
 parser.add_argument("pathToProject",                help="MKS' path to project.pj that shall be converted")
 parser.add_argument("--date-format",                help="alternative date format for parsing MKS' output", default="%x %X")
 parser.add_argument("--input-encoding",             help="encoding that MKS uses to output it's information", default="cp850")
 parser.add_argument("--drop-and-create-sandboxes",  help="don't use retarget, but drop the sandbox and create it again", action='store_true')
+parser.add_argument("--member-mode",                help="don't use sandboxes, but fetch each member revision once and build the checkpoints from them", action='store_true')
+parser.add_argument("--sandboxes",                  help="number of sandboxes that are retargeted to upcoming checkpoints concurrently", type=int, default=1)
+parser.add_argument("--si-server",                  help="command that starts a long-lived si command server (see README), instead of starting si for each command")
+parser.add_argument("--si-timeout",                 help="seconds after which a si command is aborted and tried again", type=float, default=None)
+parser.add_argument("--checkpoint-every",           help="number of commits after which git fast-import has to persist its data", type=int, default=1000)
+parser.add_argument("--checkpoint-size",            help="MB sent to git fast-import after which it has to persist its data", type=int, default=1024)
+parser.add_argument("--metadata-cache",             help="SQLite file that caches the history of the projects (default: .git/integrity2git/metadata.sqlite)")
+parser.add_argument("--refresh-metadata",           help="read the whole history from MKS instead of only the new checkpoints", action='store_true')
+parser.add_argument("--cached-metadata",            help="use the cached history without asking MKS for new checkpoints", action='store_true')
+parser.add_argument("--si-retries",                 help="number of attempts for each si command", type=int, default=20)
+parser.add_argument("--metrics",                    help="JSON-lines file to which timings, counters and the progress are written")
+parser.add_argument("--profile",                    help="file to which cProfile writes the statistics of the export (see python -m pstats)")
+parser.add_argument("--metadata-jobs",              help="number of devpath histories that are read from MKS concurrently", type=int, default=8)
+parser.add_argument("--order",                      help="order of the export: all branches one after the other, or each devpath right after its branch point, which keeps the retargets short", choices=["branches", "depth-first"], default="branches")
+parser.add_argument("--lfs-size",                   help="files of at least this many MB are stored with Git LFS", type=float)
+parser.add_argument("--lfs-pattern",                help="files that match the pattern (as in .gitattributes) are stored with Git LFS, can be given several times", action='append', default=[])
+parser.add_argument("--shared-store",               help="bare repository that is shared by several conversions (see integrity2git_many.py): the blobs of its blob index are used instead of sending them again")
+parser.add_argument("--verify",                     help="compare the trees of the converted checkpoints with the content in MKS instead of converting", action='store_true')
+parser.add_argument("--verify-sample",              help="number of randomly chosen checkpoints that --verify compares (default: all)", type=int, default=0)
+parser.add_argument("--submodules",                 help="convert shared subprojects once into repositories in this directory and link them as git submodules")
+parser.add_argument("--fix-ref-names",              help="rename branches and tags that git (or Windows) does not accept, e.g. invalid characters to '_'", action='store_true')
 args = parser.parse_args()
 
 assert os.path.isdir(".git"), "Call git init first"
+assert args.sandboxes >= 1, "At least one sandbox is needed"
+assert args.metadata_jobs >= 1, "At least one metadata job is needed"
 
 
 
@@ -62,32 +99,296 @@ class Console:
     def set_total_steps(cls, total_steps: int, already_done: int=0):
         cls.total_steps = total_steps
         cls.current_step = already_done
+        cls.first_step = already_done
+        cls.start = time.monotonic()
 
     @classmethod
     def step(cls):
+        """
+        Counts a step and writes the progress with the estimated remaining time, based on the steps of this run
+        """
         cls.current_step += 1
-        Console.trace("%d of %d (%0.2f%%)" % (cls.current_step, cls.total_steps, cls.current_step/cls.total_steps*100))
+        elapsed = time.monotonic() - cls.start
+        remaining = elapsed / (cls.current_step - cls.first_step) * (cls.total_steps - cls.current_step)
+        Console.trace("%d of %d (%0.2f%%), %s remaining" % (cls.current_step, cls.total_steps, cls.current_step/cls.total_steps*100, Console.duration(remaining)))
+        Metrics.write("step", step=cls.current_step, total=cls.total_steps, elapsed=elapsed, remaining=remaining, counters=Metrics.counters)
+
+    @staticmethod
+    def duration(seconds: float) -> str:
+        seconds = int(seconds)
+        return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+
+class Metrics:
+    """
+    Timings of the phases and counters. Spans are summed up by name; if --metrics is given, each span with
+    record=True, each step and the totals at the end are written to it as JSON lines.
+    """
+    spans = {}          # name -> [count, seconds]
+    counters = {}       # name -> value
+    lock = threading.Lock()
+    file = None
+
+    @classmethod
+    def open(cls, filename: str):
+        cls.file = open(filename, 'a', encoding="utf-8")
+
+    @classmethod
+    def write(cls, type: str, **values):
+        if not cls.file: return
+        with cls.lock:
+            cls.file.write(json.dumps(dict(type=type, time=time.time(), **values)) + "\n")
+            cls.file.flush()
+
+    @classmethod
+    @contextmanager
+    def span(cls, name: str, record: bool=True, **values):
+        """
+        Measures the time of the enclosed code
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with cls.lock:
+                span = cls.spans.setdefault(name, [0, 0.0])
+                span[0] += 1
+                span[1] += seconds
+            if record: cls.write("span", name=name, seconds=seconds, **values)
+
+    @classmethod
+    def count(cls, name: str, value: int=1):
+        with cls.lock:
+            cls.counters[name] = cls.counters.get(name, 0) + value
+
+    @classmethod
+    def report(cls):
+        for name, (count, seconds) in sorted(cls.spans.items(), key=lambda span: -span[1][1]):
+            Console.trace("%s: %d times, %0.1fs" % (name, count, seconds))
+        Console.trace(", ".join([ "%s: %d" % counter for counter in sorted(cls.counters.items()) ]))
+        cls.write("summary", spans=cls.spans, counters=cls.counters)
+
+
+
+class Stage:
+    """
+    Bounded queue between two threads of the export pipeline. The producer blocks while the queue is full, so a
+    slow consumer slows down the producer instead of letting the queue grow. Records the queue depth and how long
+    both sides had to wait. A consumer that stops early closes the stage, which lets the producer's put() raise
+    Stage.Closed instead of blocking forever.
+    """
+    statistics = {}     # name -> [items, max. queue depth, producer stall in s, consumer stall in s]
+    current = {}        # name -> Stage that was created last with this name
+    lock = threading.Lock()
+    report_interval = 60
+    last_report = time.monotonic()
+
+    class Closed(Exception):
+        pass
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+        with Stage.lock:
+            Stage.statistics.setdefault(name, [0, 0, 0.0, 0.0])
+            Stage.current[name] = self
+
+    def put(self, item):
+        if self.closed: raise Stage.Closed()
+        start = time.perf_counter()
+        self.queue.put(item)
+        stall = time.perf_counter() - start
+        depth = self.queue.qsize()
+        with Stage.lock:
+            statistics = Stage.statistics[self.name]
+            statistics[0] += 1
+            statistics[1] = max(statistics[1], depth)
+            statistics[2] += stall
+
+    def get(self):
+        start = time.perf_counter()
+        item = self.queue.get()
+        stall = time.perf_counter() - start
+        with Stage.lock:
+            Stage.statistics[self.name][3] += stall
+        return item
+
+    def close(self):
+        """
+        Discards the queued items. The producer gets Stage.Closed on its next put().
+        """
+        self.closed = True
+        while True: # unblocks a producer that waits in put()
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    @classmethod
+    def report(cls):
+        cls.last_report = time.monotonic()
+        with cls.lock:
+            for name, (items, depth, producer_stall, consumer_stall) in cls.statistics.items():
+                Console.trace("%s: %d items, queue depth %d (max. %d), producer stalled %0.1fs, consumer stalled %0.1fs" % (name, items, cls.current[name].queue.qsize(), depth, producer_stall, consumer_stall))
+
+    @classmethod
+    def report_if_due(cls):
+        if time.monotonic() - cls.last_report >= cls.report_interval: cls.report()
 
 
 
 class GitFastImport:
-    def __init__(self):
-        self.process = subprocess.Popen(["git", "fast-import"], stdin=subprocess.PIPE)
+    def __init__(self, state_dir: str, shared_store: str=None, read_only: bool=False):
+        self.state_dir = state_dir
+        self.marks_file = os.path.join(state_dir, "marks")
+        self.blobs_file = os.path.join(state_dir, "blobs")
+        os.makedirs(state_dir, exist_ok=True)
+
+        marks = self.read_marks()
+        self.last_mark = max([ int(m[1:]) for m in marks ], default=0)
+        self.blobs = {}         # sha -> mark of all blobs that were sent to git, or the sha for blobs of the shared store
+        self.new_blobs = []     # sha of blobs that are not yet written to the blobs file
+        if os.path.isfile(self.blobs_file):
+            for line in open(self.blobs_file, 'r'):
+                sha, mark = line.split()
+                if marks.get(mark) == sha: # otherwise git did not persist the blob
+                    self.blobs[sha] = mark
+        if shared_store:
+            self.use_shared_store(shared_store)
+
+        self.bytes_sent = 0
+        self.checkpoints = 0
+        self.process = None
+        if read_only: return # for --verify, blobs are only hashed
+        self.process = subprocess.Popen(["git", "fast-import", "--import-marks-if-exists=" + self.marks_file, "--export-marks=" + self.marks_file], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.progress = queue.Queue()   # progress messages of git fast-import
+        threading.Thread(target=self.read_output, daemon=True).start()
+        self.buffer = bytearray()   # commands that are not yet handed to the writer
+        self.writer_queue = Stage("git fast-import writer", 16)
+        self.writer_error = None
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    buffer_size = 4*1024*1024
+
+    def use_shared_store(self, shared_store: str):
+        """
+        Makes the objects of the shared store available to the repository as alternates, and uses the blobs of its
+        blob index by their sha instead of a mark
+        """
+        objects = os.path.abspath(os.path.join(shared_store, "objects"))
+        assert os.path.isdir(objects), f"{shared_store} is no git repository"
+        alternates = os.path.join(".git", "objects", "info", "alternates")
+        if not os.path.isfile(alternates) or objects not in open(alternates, 'r').read().splitlines():
+            os.makedirs(os.path.dirname(alternates), exist_ok=True)
+            with open(alternates, 'a') as f:
+                f.write(objects + "\n")
+        index_file = os.path.join(shared_store, "integrity2git", "blobs")
+        if os.path.isfile(index_file):
+            for line in open(index_file, 'r'):
+                sha = line.strip()
+                if sha: self.blobs.setdefault(sha, sha)
+
+    def write(self):
+        """
+        Writer thread that owns the pipe to git fast-import
+        """
+        while True:
+            data = self.writer_queue.get()
+            if data is None: break
+            if self.writer_error: continue # keep the queue flowing until the end
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush() # a checkpoint waits for the answer of git fast-import
+            except Exception as ex:
+                self.writer_error = ex
+
+    def read_output(self):
+        for line in self.process.stdout:
+            line = line.decode("utf-8", "replace").rstrip("\n")
+            if line.startswith("progress "):
+                self.progress.put(line[len("progress "):])
+            else:
+                print(line)
+        self.progress.put(None)
+
+    def send(self, data: bytes):
+        """
+        Adds data to the buffer, which is handed to the writer thread when it is full
+        """
+        if not self.process: return
+        self.bytes_sent += len(data)
+        if len(data) >= GitFastImport.buffer_size:
+            self.flush()
+            self.writer_queue.put(data)
+        else:
+            self.buffer += data
+            if len(self.buffer) >= GitFastImport.buffer_size: self.flush()
+
+    def flush(self):
+        if self.writer_error: raise Exception("Writing to git fast-import failed") from self.writer_error
+        if self.buffer:
+            self.writer_queue.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def close(self):
+        """
+        Sends all remaining commands and waits until git fast-import has finished
+        """
+        if not self.process: return
+        self.flush()
+        self.writer_queue.put(None)
+        self.writer.join()
+        self.process.stdin.close()
+        assert self.process.wait() == 0, "git fast-import failed"
+        if self.writer_error: raise Exception("Writing to git fast-import failed") from self.writer_error
+
+    def read_marks(self) -> Dict[str, str]:
+        """
+        Reads the marks file that git fast-import exports: mark -> sha
+        """
+        marks = {}
+        if os.path.isfile(self.marks_file):
+            for line in open(self.marks_file, 'r'):
+                mark, sha = line.split()
+                marks[mark] = sha
+        return marks
+
+    def new_mark(self) -> str:
+        self.last_mark += 1
+        return ":%d" % self.last_mark
 
     def command(self, data: str):
         """
         Writes a command to git fast-import
         """
-        self.process.stdin.write(data.encode("utf-8"))
-        self.process.stdin.write('\n'.encode("utf-8"))
+        self.send(data.encode("utf-8") + b'\n')
+
+    def checkpoint(self):
+        """
+        Lets git fast-import write its data, refs and marks and waits until it is done, then stores which blobs were sent
+        """
+        self.checkpoints += 1
+        self.command('checkpoint')
+        self.command('progress checkpoint %d' % self.checkpoints)
+        self.flush()
+        assert self.progress.get() == "checkpoint %d" % self.checkpoints, "git fast-import failed"
+        if self.new_blobs:
+            with open(self.blobs_file, 'a') as f:
+                for sha in self.new_blobs:
+                    f.write("%s %s\n" % (sha, self.blobs[sha]))
+            self.new_blobs = []
 
     def export_data(self, string: bytes):
         """
         Writes binary data to git
         """
-        self.process.stdin.write(('data %d\n' % len(string)).encode("utf-8"))
-        self.process.stdin.write(string)
-        self.process.stdin.write('\n'.encode("utf-8"))
+        self.send(('data %d\n' % len(string)).encode("utf-8"))
+        self.send(string)
+        self.send(b'\n')
 
     def export_string(self, string: str):
         """
@@ -95,16 +396,214 @@ class GitFastImport:
         """
         self.export_data(string.encode("utf-8"))
 
-    def export_file(self, filename: str, code = 'M', mode = '644'):
+    chunk_size = 1024*1024
+    buffered_blob_size = 16*1024*1024
+
+    def start_blob(self, size: int) -> str:
+        mark = self.new_mark()
+        self.command('blob')
+        self.command('mark %s' % mark)
+        self.send(('data %d\n' % size).encode("utf-8"))
+        return mark
+
+    def export_blob(self, name: str, size: int, chunks, sha: str=None) -> Tuple[str, str]:
         """
-        Writes a file to git
+        Writes content of the given size, that is read from chunks, as blob to git, unless a blob with the same content
+        was sent before. Returns the mark and the sha of the blob. Content up to buffered_blob_size is hashed before it
+        is sent, larger content is hashed while it is streamed, so it is read only once and never loaded completely.
+        """
+        if sha in self.blobs: return self.blobs[sha], sha
+        check = hashlib.sha1(b"blob %d\0" % size)
+        buffered = []
+        length = 0
+        mark = None
+        for chunk in chunks:
+            check.update(chunk)
+            length += len(chunk)
+            # git fast-import cannot recover from a wrong length, so give up rather than write a corrupt stream
+            assert length <= size, f"{name} changed its size while being exported"
+            if mark:
+                self.send(chunk)
+            else:
+                buffered.append(chunk)
+                if length > GitFastImport.buffered_blob_size:
+                    mark = self.start_blob(size)
+                    for data in buffered: self.send(data)
+                    buffered = None
+        assert length == size, f"{name} changed its size while being exported"
+        blob_sha = check.hexdigest()
+        assert not sha or blob_sha == sha, f"{name} changed while being exported"
+        if not mark:
+            if blob_sha in self.blobs: return self.blobs[blob_sha], blob_sha
+            mark = self.start_blob(size)
+            for data in buffered: self.send(data)
+        self.send(b'\n')
+        if blob_sha not in self.blobs: # otherwise a large file was sent again, git stores it only once
+            self.blobs[blob_sha] = mark
+            self.new_blobs.append(blob_sha)
+        Metrics.count("blobs sent")
+        Metrics.count("blob bytes sent", size)
+        return self.blobs[blob_sha], blob_sha
+
+    def export_file(self, filename: str, mark: str, code = 'M', mode = '644'):
+        """
+        Writes a file to git that references a blob
         """
-        content = open(filename, 'rb').read()
         if platform.system() == 'Windows':
             #this is a hack'ish way to get windows path names to work git (is there a better way to do this?)
             filename = filename.replace('\\','/')
-        self.command("%s %s inline %s" % (code, mode, filename))
-        self.export_data(content)
+        self.command("%s %s %s %s" % (code, mode, mark, filename))
+
+
+class SiSession:
+    """
+    Runs the MKS CLI commands and yields their output while it arrives. Either si is started for each command, or
+    the commands are sent to long-lived command servers that keep their connection to the MKS server. A command
+    server reads one command per line from stdin, writes its output to stdout and ends it with a line consisting of
+    the terminator and the exit code. One server is used per concurrent command; if servers keep failing, the
+    session falls back to starting si for each command.
+    """
+    terminator = "\x1e"
+    max_server_failures = 3
+
+    class Failed(Exception):
+        pass
+
+    class Reader:
+        """
+        Reads the lines of a pipe in a separate thread, so reading can time out
+        """
+        def __init__(self, pipe):
+            self.lines = queue.Queue()
+            threading.Thread(target=self.read, args=(pipe,), daemon=True).start()
+
+        def read(self, pipe):
+            for line in pipe:
+                self.lines.put(line)
+            self.lines.put(None)
+
+        def readline(self, deadline: float) -> bytes:
+            """
+            Returns the next line, or None at the end of the output
+            """
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                return self.lines.get(timeout=timeout)
+            except queue.Empty:
+                raise SiSession.Failed("Timeout after %d seconds" % args.si_timeout)
+
+    class Server:
+        def __init__(self, command: str):
+            self.process = subprocess.Popen(split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.reader = SiSession.Reader(self.process.stdout)
+
+        def stop(self):
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+
+    def __init__(self, server_command: str=None):
+        self.server_command = server_command
+        self.servers = queue.Queue()        # idle servers
+        self.server_failures = 0
+        self.lock = threading.Lock()        # commands run in several threads
+
+    def lines(self, command: str):
+        """
+        Runs the command and yields its output line by line. Raises SiSession.Failed with the last lines of the
+        output, which explain the error, if the command fails.
+        """
+        deadline = None if args.si_timeout is None else time.monotonic() + args.si_timeout
+        server = self.acquire_server()
+        output = deque(maxlen=20)
+        try:
+            for line in self.server_lines(server, command, deadline) if server else self.process_lines(command, deadline):
+                output.append(line)
+                yield line
+        except SiSession.Failed as ex:
+            if not output: raise
+            raise SiSession.Failed("%s: %s" % (ex, "\n".join(output)))
+
+    def acquire_server(self):
+        if not self.server_command or self.server_failures >= SiSession.max_server_failures: return None
+        try:
+            return self.servers.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return SiSession.Server(self.server_command)
+        except OSError as ex:
+            self.server_failed("Cannot start si command server: %s" % ex)
+            return None
+
+    def server_failed(self, message: str):
+        Console.error(">>> " + message)
+        with self.lock:
+            self.server_failures += 1
+            fall_back = self.server_failures == SiSession.max_server_failures
+        if fall_back:
+            Console.error(">>> Starting si for each command from now on")
+
+    def server_lines(self, server: Server, command: str, deadline: float):
+        completed = False
+        try:
+            server.process.stdin.write((command + "\n").encode(args.input_encoding))
+            server.process.stdin.flush()
+            while True:
+                line = server.reader.readline(deadline)
+                if line is None:
+                    self.server_failed("si command server exited")
+                    raise SiSession.Failed("si command server exited")
+                line = line.decode(args.input_encoding).rstrip("\r\n")
+                if line.startswith(SiSession.terminator):
+                    exitcode = int(line[len(SiSession.terminator):])
+                    break
+                yield line
+            completed = True
+        except GeneratorExit: # the caller needs no more output, skip the rest to keep the server
+            completed = self.skip_output(server, deadline)
+            raise
+        except OSError as ex:
+            self.server_failed("si command server failed: %s" % ex)
+            raise SiSession.Failed(str(ex))
+        finally:
+            if completed: self.servers.put(server)
+            else: server.stop() # the state of its output is unknown
+        if exitcode != 0:
+            raise SiSession.Failed("Returned %d" % exitcode)
+
+    def skip_output(self, server: Server, deadline: float) -> bool:
+        """
+        Skips the rest of the output of the current command. Returns whether the server is ready for the next one.
+        """
+        try:
+            while True:
+                line = server.reader.readline(deadline)
+                if line is None: return False
+                if line.decode(args.input_encoding).startswith(SiSession.terminator): return True
+        except SiSession.Failed:
+            return False
+
+    def process_lines(self, command: str, deadline: float):
+        process = subprocess.Popen(split(command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            reader = SiSession.Reader(process.stdout)
+            while True:
+                line = reader.readline(deadline)
+                if line is None: break
+                yield line.decode(args.input_encoding).rstrip("\r\n")
+        finally:
+            if process.poll() is None:
+                process.kill()
+            exitcode = process.wait()
+        if exitcode != 0:
+            raise SiSession.Failed("Returned %d" % exitcode)
+
+    def close(self):
+        while not self.servers.empty():
+            server = self.servers.get()
+            server.process.stdin.close()
+            server.stop()
 
 
 class MKS:
@@ -113,9 +612,12 @@ class MKS:
         if not project.endswith(".pj"): self.project += "/project.pj"
         self.projectName = os.path.basename(self.project)
         self.sandboxPath = os.path.join(os.getcwd(), "tmp").replace("\\", "/")
+        self.session = SiSession(args.si_server)
         pass
 
     class Revision:
+        __slots__ = ("number", "author", "seconds", "tags", "description", "ancestor") # there can be a lot of them
+
         def __init__(self):
             self.number = None          # str with version number
             self.author = None          # str
@@ -125,10 +627,20 @@ class MKS:
             self.ancestor = None        # previous Revision
 
     class Tag:
+        __slots__ = ("name", "git_name")
+        cache = {}      # name -> Tag, a label is often read several times
+
         def __init__(self, name):
             self.name = name                            # str with name of tag in MKS
             self.git_name = convert_tag_name(name)      # str with name of tag in Git
 
+        @staticmethod
+        def get(name: str):
+            tag = MKS.Tag.cache.get(name)
+            if not tag:
+                tag = MKS.Tag.cache[name] = MKS.Tag(name)
+            return tag
+
     class DevPath:
         def __init__(self, name, ancestor):
             self.name = name                            # str with name of branch in MKS
@@ -137,310 +649,1378 @@ class MKS:
             self.revisions = None                       # Revisions in this branch
 
 
-    def __si(self, command: str) -> str:
+    def __si(self, command: str, parse=None):
         """
-        Executes the MKS CLI command
+        Executes the MKS CLI command and returns its output, or the result of parse() that gets the output line by line
         """
         Console.trace(command)
-        for i in range(20):
+        for i in range(args.si_retries):
+            lines = self.session.lines(command)
             try:
-                data = subprocess.check_output(command, stderr=subprocess.STDOUT)
-                exitcode = 0
-            except subprocess.CalledProcessError as ex:
-                data = ex.output
-                exitcode = ex.returncode
-            if data[-1:] == '\n':
-                data = data[:-1]
-
-            if exitcode == 0: break
-            Console.error(">>> Returned %d: %s" % (exitcode, data))
-            Console.error(">>> %s trying again" % datetime.now().strftime("%H:%M:%S"))
-            time.sleep(1)
-        else:
-            raise Exception("Command failed")
-        return data.decode(args.input_encoding)
-
-
-    def retrieve_revisions(self, devpath: DevPath=None) -> List[Revision]:
+                with Metrics.span(" ".join(command.split()[:2]), attempt=i + 1):
+                    try:
+                        if parse: return parse(lines)
+                        return "\n".join(lines)
+                    except SiSession.Failed:
+                        raise
+                    except Exception:
+                        for line in lines: pass # a failed command explains the error and is tried again
+                        raise
+            except SiSession.Failed as ex:
+                Console.error(">>> %s: %s" % (command, ex))
+            if i + 1 == args.si_retries: break
+            Metrics.count("si retries")
+            delay = min(2 ** i, 60)
+            Console.error(">>> %s trying again in %d s" % (datetime.now().strftime("%H:%M:%S"), delay))
+            time.sleep(delay)
+        raise Exception("Command failed")
+
+
+    def retrieve_revisions(self, devpath: DevPath=None, known: set=None) -> List[Revision]:
+        """
+        Returns all revisions of the devpath, or only those that are newer than the newest of the known revision numbers.
+        Neither ignore_revisions nor ignore_tags are applied, see filter_revisions().
+        """
         devpathStr = '"' + devpath.name + '"' if devpath else ":current"
-
-        versions = self.__si('si viewprojecthistory %s --quiet --rfilter=devpath:%s --project="%s"' % (additional_si_args, devpathStr, self.project))
-        versions = versions.split('\n')
-        versions = versions[1:]
         version_re = re.compile('^\d+(\.\d+)+\t')
 
-        revisions = []
-        for version in versions:
-            match = version_re.match(version)
-            if match:
-                version_cols = version.split('\t')
-                revision = MKS.Revision()
-                revision.number = version_cols[0]
-                revision.author = version_cols[1]
-                revision.seconds = int(time.mktime(datetime.strptime(version_cols[2], args.date_format).timetuple()))
-                revision.tags = [ MKS.Tag(v) for v in version_cols[5].split(",") if v and v not in ignore_tags ]
-                revision.description = version_cols[6]
-                if not revision.number in ignore_revisions:
+        def parse(versions):
+            next(versions, None) # skip the header
+            revisions = []
+            description = []    # lines of the description of the last revision
+            for version in versions:
+                match = version_re.match(version)
+                if match:
+                    version_cols = version.split('\t')
+                    if known and version_cols[0] in known: break # the history is ordered from new to old
+                    if revisions: revisions[-1].description = '\n'.join(description)
+                    revision = MKS.Revision()
+                    revision.number = version_cols[0]
+                    revision.author = sys.intern(version_cols[1])
+                    revision.seconds = int(time.mktime(datetime.strptime(version_cols[2], args.date_format).timetuple()))
+                    revision.tags = [ MKS.Tag.get(v) for v in version_cols[5].split(",") if v ]
+                    description = [ version_cols[6] ] if version_cols[6] else []
                     revisions.append(revision)
-            else: # append to previous description
-                if not version: continue
-                if revision.description: revision.description += '\n'
-                revision.description += version
+                else: # append to previous description
+                    if not version: continue
+                    description.append(version)
+            if revisions: revisions[-1].description = '\n'.join(description)
+            return revisions
 
+        revisions = self.__si('si viewprojecthistory %s --quiet --rfilter=devpath:%s --project="%s"' % (additional_si_args, devpathStr, self.project), parse)
         revisions.reverse() # Old to new
         return revisions
 
-    def retrieve_devpaths(self) -> List[DevPath]:
-        devpaths = self.__si('si projectinfo %s --devpaths --quiet --noacl --noattributes --noshowCheckpointDescription --noassociatedIssues --project="%s"' % (additional_si_args, self.project))
-        devpaths = devpaths [1:]
-        devpaths_re = re.compile('    (.+) \(([0-9][\.0-9]+)\)\n')
-        devpath_col = devpaths_re.findall(devpaths)
+    @staticmethod
+    def filter_revisions(revisions: List[Revision]) -> List[Revision]:
+        """
+        Removes the revisions and tags that shall be ignored
+        """
+        for revision in revisions:
+            revision.tags = [ tag for tag in revision.tags if tag.name not in ignore_tags ]
+        return [ revision for revision in revisions if not revision.number in ignore_revisions ]
+
+    def retrieve_devpaths(self, ignore: bool=True) -> List[DevPath]:
+        devpaths_re = re.compile('^    (.+) \(([0-9][\.0-9]+)\)$')
+
+        def parse(lines):
+            return [ match.groups() for match in map(devpaths_re.match, lines) if match ]
+
+        devpath_col = self.__si('si projectinfo %s --devpaths --quiet --noacl --noattributes --noshowCheckpointDescription --noassociatedIssues --project="%s"' % (additional_si_args, self.project), parse)
         devpath_col.sort(key=lambda x: [int(i) for i in x[1].split('.')]) #order development paths by version
-        return [ MKS.DevPath(dp[0], dp[1]) for dp in devpath_col if not dp[0] in ignore_devpaths ]
+        return [ MKS.DevPath(dp[0], dp[1]) for dp in devpath_col if not (ignore and dp[0] in ignore_devpaths) ]
 
-    def create_sandbox(self, revision: Revision):
-        self.__si('si createsandbox %s --populate --recurse --quiet --project="%s" --projectRevision=%s "%s"' % (additional_si_args, self.project, revision.number, self.sandboxPath))
+    def create_sandbox(self, revision: Revision, sandbox: str=None):
+        sandbox = sandbox or self.sandboxPath
+        self.__si('si createsandbox %s --populate --recurse --quiet --project="%s" --projectRevision=%s "%s"' % (additional_si_args, self.project, revision.number, sandbox))
 
-    def drop_sandbox(self):
-        self.__si('si dropsandbox --yes -f --delete=all "%s/%s"' % (self.sandboxPath, self.projectName))
+    def drop_sandbox(self, sandbox: str=None):
+        sandbox = sandbox or self.sandboxPath
+        self.__si('si dropsandbox --yes -f --delete=all "%s/%s"' % (sandbox, self.projectName))
 
-    def retarget(self, revision: Revision):
-        self.__si('si retargetsandbox %s --quiet --project="%s" --projectRevision=%s "%s/%s"' % (additional_si_args, self.project, revision.number, self.sandboxPath, self.projectName))
+    def retarget(self, revision: Revision, sandbox: str=None):
+        sandbox = sandbox or self.sandboxPath
+        self.__si('si retargetsandbox %s --quiet --project="%s" --projectRevision=%s "%s/%s"' % (additional_si_args, self.project, revision.number, sandbox, self.projectName))
 
-    def resync(self):
-        self.__si('si resync --yes --recurse %s --quiet --sandbox="%s/%s"' % (additional_si_args, self.sandboxPath, self.projectName))
+    def resync(self, sandbox: str=None):
+        sandbox = sandbox or self.sandboxPath
+        self.__si('si resync --yes --recurse %s --quiet --sandbox="%s/%s"' % (additional_si_args, sandbox, self.projectName))
 
-    def retarget_to(self, revision: Revision):
-        if args.drop_and_create_sandboxes:
-            self.drop_sandbox()
-            self.create_sandbox(revision)
-        else:
-            self.retarget(revision)
-            self.resync()
+    def retrieve_members(self, revision: Revision) -> Dict[str, Tuple[str, str]]:
+        """
+        Returns path -> (archive, member revision) of all members in the revision of the project and its subprojects.
+        A member revision number is only unique within its archive, e.g. a shared subproject at the same path can
+        be switched to another project.
+        """
+        prefix = os.path.dirname(self.project) + "/"
+
+        def parse(lines):
+            members = {}
+            for line in lines:
+                cols = line.split(None, 2)
+                if len(cols) < 3 or "project" in cols[0]: continue # only members, not subprojects
+                separator = cols[2].find(" " + prefix) # archive and name may contain blanks, the name is in the project
+                archive, name = (cols[2][:separator], cols[2][separator + 1:]) if separator > 0 else cols[2].split(None, 1)
+                if name.startswith(prefix): name = name[len(prefix):]
+                members[name] = (archive, cols[1])
+            return members
+
+        return self.__si('si viewproject %s --recurse --quiet --project="%s" --projectRevision=%s --fields=type,memberrev,memberarchive,name' % (additional_si_args, self.project, revision.number), parse)
+
+    def retrieve_shared_subprojects(self, revision: Revision) -> Dict[str, Tuple[str, str]]:
+        """
+        Returns path -> (project, revision) of the shared subprojects in the revision of the project and its
+        subprojects, without those that are part of another shared subproject
+        """
+        prefix = os.path.dirname(self.project) + "/"
+        subproject_re = re.compile(r'^(\S*shared\S*) (\d+(?:\.\d+)+) (.+?\.pj) (.+)$')
+
+        def parse(lines):
+            subprojects = {}
+            for match in map(subproject_re.match, lines):
+                if not match: continue # members, other subprojects and shared subprojects without configured revision
+                name = os.path.dirname(match.group(4))
+                if name.startswith(prefix): name = name[len(prefix):]
+                subprojects[name] = (match.group(3), match.group(2))
+            return { path: subproject for path, subproject in subprojects.items() if not Convert.is_within(path, subprojects) }
+
+        return self.__si('si viewproject %s --recurse --quiet --project="%s" --projectRevision=%s --fields=type,memberrev,memberarchive,name' % (additional_si_args, self.project, revision.number), parse)
+
+    def checkout_member(self, revision: Revision, member: str, member_revision: str, filename: str):
+        self.__si('si projectco %s --nolock --quiet --overwriteExisting --project="%s" --projectRevision=%s --revision=%s --targetFile="%s" "%s"' % (additional_si_args, self.project, revision.number, member_revision, filename, member))
+
+    def retarget_to(self, revision: Revision, sandbox: str=None):
+        with Metrics.span("retarget", revision=revision.number):
+            if args.drop_and_create_sandboxes:
+                self.drop_sandbox(sandbox)
+                self.create_sandbox(revision, sandbox)
+            else:
+                self.retarget(revision, sandbox)
+                self.resync(sandbox)
         return
 
 
 
+class MetadataCache:
+    """
+    Stores the history and the development paths of MKS projects in a SQLite database, so that only checkpoints
+    which were added since the last run have to be read from MKS. The revisions are stored as MKS reports them,
+    ignore_revisions, ignore_tags and ignore_devpaths are applied after loading them.
+    """
+    def __init__(self, filename: str, mks: MKS):
+        self.mks = mks
+        self.project = mks.project
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=60) # may be shared by concurrent conversions
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS revisions (project TEXT, devpath TEXT, position INTEGER, number TEXT, author TEXT, seconds INTEGER, tags TEXT, description TEXT, PRIMARY KEY (project, devpath, position));
+            CREATE TABLE IF NOT EXISTS devpaths (project TEXT, position INTEGER, name TEXT, ancestor TEXT, PRIMARY KEY (project, position));
+        """)
+
+    def load_revisions(self, devpath: str) -> List[MKS.Revision]:
+        revisions = []
+        for number, author, seconds, tags, description in self.db.execute("SELECT number, author, seconds, tags, description FROM revisions WHERE project = ? AND devpath = ? ORDER BY position", (self.project, devpath)):
+            revision = MKS.Revision()
+            revision.number = number
+            revision.author = sys.intern(author)
+            revision.seconds = seconds
+            revision.tags = [ MKS.Tag.get(tag) for tag in tags.split(",") if tag ]
+            revision.description = description
+            revisions.append(revision)
+        return revisions
+
+    def store_revisions(self, devpath: str, revisions: List[MKS.Revision], position: int):
+        """
+        Stores the revisions (old to new) starting at position, replacing all revisions that were stored there before
+        """
+        with self.db:
+            self.db.execute("DELETE FROM revisions WHERE project = ? AND devpath = ? AND position >= ?", (self.project, devpath, position))
+            self.db.executemany("INSERT INTO revisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((self.project, devpath, position + i, r.number, r.author, r.seconds, ",".join([ t.name for t in r.tags ]), r.description) for i, r in enumerate(revisions)))
+
+    def retrieve_revisions(self, devpath: MKS.DevPath=None) -> List[MKS.Revision]:
+        """
+        Returns the revisions of the devpath from the cache, after adding the checkpoints that are new in MKS
+        """
+        name = devpath.name if devpath else ""
+        revisions = [] if args.refresh_metadata else self.load_revisions(name)
+        if not args.cached_metadata:
+            new_revisions = self.mks.retrieve_revisions(devpath, known=set([ r.number for r in revisions ]))
+            self.store_revisions(name, new_revisions, len(revisions))
+            revisions += new_revisions
+        return MKS.filter_revisions(revisions)
+
+    def retrieve_devpath_revisions(self, devpaths: List[MKS.DevPath]):
+        """
+        Sets the revisions of the devpaths like retrieve_revisions(). The histories are read from MKS concurrently,
+        the database is only used by the calling thread. If some histories cannot be read, the others are stored
+        anyway before the failure is raised, so the next run only has to read the missing ones.
+        """
+        cached = { dp.name: [] if args.refresh_metadata else self.load_revisions(dp.name) for dp in devpaths }
+        failed = []
+        if not args.cached_metadata:
+            with ThreadPoolExecutor(args.metadata_jobs) as executor:
+                futures = [ (dp, executor.submit(self.mks.retrieve_revisions, dp, set([ r.number for r in cached[dp.name] ]))) for dp in devpaths ]
+                for devpath, future in futures:
+                    try:
+                        new_revisions = future.result()
+                    except Exception as ex:
+                        Console.error(f"Could not retrieve the history of devpath {devpath.name}: {ex}")
+                        failed.append(devpath.name)
+                        continue
+                    self.store_revisions(devpath.name, new_revisions, len(cached[devpath.name]))
+                    cached[devpath.name] += new_revisions
+        assert not failed, "Could not retrieve the history of devpaths: " + ", ".join(failed)
+        for devpath in devpaths:
+            devpath.revisions = MKS.filter_revisions(cached[devpath.name])
+
+    def retrieve_devpaths(self) -> List[MKS.DevPath]:
+        if args.cached_metadata:
+            devpaths = [ MKS.DevPath(name, ancestor) for name, ancestor in self.db.execute("SELECT name, ancestor FROM devpaths WHERE project = ? ORDER BY position", (self.project,)) ]
+        else:
+            devpaths = self.mks.retrieve_devpaths(ignore=False)
+            with self.db:
+                self.db.execute("DELETE FROM devpaths WHERE project = ?", (self.project,))
+                self.db.executemany("INSERT INTO devpaths VALUES (?, ?, ?, ?)", [ (self.project, i, dp.name, dp.ancestor) for i, dp in enumerate(devpaths) ])
+        return [ dp for dp in devpaths if not dp.name in ignore_devpaths ]
+
+
+
 class Convert:
     def __init__(self, mks: MKS, git: GitFastImport):
         self.mks = mks
         self.git = git
         self.repo = Repo(os.getcwd())
         self.marks = {}
+        self.state_dir = git.state_dir
+        self.manifests = {}         # git branch name -> Manifest
+        self.index_file = os.path.join(self.state_dir, "revisions")
+        self.journal_file = self.index_file + ".pending"
+        self.legacy_resume = not os.path.isfile(self.index_file) and self.repo.head.is_valid() # converted by an older version of this script
+        self.revision_index = self.read_revision_index()   # number of Revision -> sha of commit
+        self.unindexed = []         # numbers of Revisions committed since the last checkpoint
+        self.checkpoint_bytes = 0
+        self.branch_tips = {}       # git branch name -> Revision that was committed last in this session
+        self.finished = []          # git branch names whose manifest is not needed after the next checkpoint
+        self.trees_file = os.path.join(self.state_dir, "trees")
+        self.trees = set()          # ids of the trees that git has, so a directory can be written as a reference to its tree
+        self.new_trees = []         # ids of trees that are not yet written to the trees file
+        if os.path.isfile(self.trees_file):
+            self.trees.update(open(self.trees_file, 'r').read().split())
+        if args.sandboxes == 1:
+            self.sandboxes = [ Convert.Sandbox(mks.sandboxPath) ]
+        else:
+            self.sandboxes = [ Convert.Sandbox("%s/%d" % (mks.sandboxPath, i)) for i in range(args.sandboxes) ]
+        if args.member_mode:
+            self.member_cache = Convert.MemberCache(os.path.join(self.state_dir, "members"))
+        self.submodules = Convert.Submodules(self, args.submodules) if args.submodules else None
+        self.lfs = Convert.Lfs(git, os.path.join(os.path.dirname(self.state_dir), "lfs")) if args.lfs_size is not None or args.lfs_pattern else None
         Console.trace("Git directory: %s" % self.repo.common_dir)
         pass
 
+    def read_revision_index(self) -> Dict[str, str]:
+        index = {}
+        if os.path.isfile(self.index_file):
+            for line in open(self.index_file, 'r'):
+                number, sha = line.split()
+                index[number] = sha
+        elif not self.legacy_resume:
+            open(self.index_file, 'w').close()
+        if os.path.isfile(self.journal_file): # the last run stopped during a checkpoint
+            marks = self.git.read_marks()
+            pending = [ line.split() for line in open(self.journal_file, 'r') ]
+            self.add_to_revision_index(index, [ (number, marks[mark]) for number, mark in pending if mark in marks ])
+            os.remove(self.journal_file)
+        return index
+
+    def add_to_revision_index(self, index: Dict[str, str], entries: List[Tuple[str, str]]):
+        with open(self.index_file, 'a') as f:
+            for number, sha in entries:
+                f.write("%s %s\n" % (number, sha))
+                index[number] = sha
+
+    class Manifest:
+        """
+        The files of the last exported revision of a branch. It is stored in the git directory to
+        export only the changed files of the next revision, even after a restart of the conversion.
+        """
+        def __init__(self, filename: str):
+            self.filename = filename
+            self.revision = None        # str with number of the revision the files belong to
+            self.files = {}             # path -> [size, mtime, sha], or [0, None, sha of commit, "160000"] for a submodule
+            self.trees = None           # directory ("" is the root) -> git tree id of the files, None if unknown
+            self.dirty = False          # whether it changed since it was saved
+            if os.path.isfile(filename):
+                with open(filename, 'r', encoding="utf-8") as f:
+                    data = json.load(f)
+                self.revision = data["revision"]
+                self.files = data["files"]
+                self.trees = data.get("trees") # written by an older version without them
+
+        def save(self):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename + ".tmp", 'w', encoding="utf-8") as f:
+                json.dump({ "revision": self.revision, "files": self.files, "trees": self.trees }, f)
+            os.replace(self.filename + ".tmp", self.filename)
+            self.dirty = False
+
+    class Sandbox:
+        def __init__(self, path: str):
+            self.path = path            # str with directory of the sandbox
+            self.files = {}             # path -> [size, mtime, sha] found by the last scan of the sandbox
+
+        def filename(self, path: str) -> str:
+            return os.path.join(self.path, path)
+
+    class MemberCache:
+        """
+        Content of member revisions for --member-mode. Each member revision is fetched once from MKS and used for
+        all checkpoints and devpaths that contain it.
+        """
+        def __init__(self, directory: str):
+            self.directory = directory
+            self.index_file = os.path.join(directory, "index")
+            self.index = {}             # (archive, member revision) -> [size, sha]
+            self.lock = threading.Lock()
+            os.makedirs(directory, exist_ok=True)
+            if os.path.isfile(self.index_file):
+                for line in open(self.index_file, 'r', encoding="utf-8"):
+                    sha, size, member_revision, archive = line.rstrip("\n").split(" ", 3)
+                    self.index[(archive, member_revision)] = [int(size), sha]
+
+        def filename(self, member: Tuple[str, str]) -> str:
+            return os.path.join(self.directory, hashlib.sha1(("%s\0%s" % member).encode("utf-8")).hexdigest())
+
+        def fetch(self, mks: MKS, revision: MKS.Revision, path: str, member: Tuple[str, str]):
+            """
+            Checks out the member (archive, member revision) at the path in the revision
+            """
+            filename = self.filename(member)
+            mks.checkout_member(revision, path, member[1], filename)
+            size = os.path.getsize(filename)
+            entry = [size, Convert.hash_file(filename, size)]
+            with self.lock:
+                self.index[member] = entry
+                with open(self.index_file, 'a', encoding="utf-8") as f:
+                    f.write("%s %d %s %s\n" % (entry[1], size, member[1], member[0]))
+
+    class FileReader:
+        """
+        Reads the files of a checkpoint in chunks in a separate thread, so the disk is busy while the content of the
+        previous files is hashed and sent to git. The content is consumed with chunks() in the order of the paths.
+        """
+        def __init__(self, source, paths: List[str]):
+            self.read = Stage("file reader", 64)
+            threading.Thread(target=self.read_files, args=(source, paths), daemon=True).start()
+
+        def read_files(self, source, paths: List[str]):
+            try:
+                for path in paths:
+                    with open(source.filename(path), 'rb') as f:
+                        for chunk in iter(lambda: f.read(GitFastImport.chunk_size), b''):
+                            self.read.put(chunk)
+                    self.read.put(None)
+            except Stage.Closed:
+                pass
+            except Exception as ex:
+                self.read.put(ex)
+
+        def chunks(self):
+            """
+            Yields the content of the next file
+            """
+            while True:
+                chunk = self.read.get()
+                if chunk is None: return
+                if isinstance(chunk, Exception): raise chunk
+                yield chunk
+
+        def close(self):
+            self.read.close()
+
+    class MemberTree:
+        """
+        The members of one checkpoint, read from the MemberCache
+        """
+        def __init__(self, convert, revision: MKS.Revision, members: Dict[str, str]):
+            self.convert = convert
+            self.revision = revision
+            self.members = members      # path -> (archive, member revision)
+
+        def filename(self, path: str) -> str:
+            cache = self.convert.member_cache
+            filename = cache.filename(self.members[path])
+            if not os.path.isfile(filename): # e.g. the cache was cleaned up
+                cache.fetch(self.convert.mks, self.revision, path, self.members[path])
+            return filename
+
+    class Submodules:
+        """
+        Shared subprojects for --submodules. Each shared subproject is converted once into its own repository by
+        running this script for it. The parent commits get a gitlink to the commit of the configured subproject
+        revision and a .gitmodules file instead of the files of the subproject.
+        """
+        def __init__(self, convert, directory: str):
+            self.convert = convert
+            self.directory = os.path.abspath(directory)
+            self.revisions = {}     # number of Revision -> { path -> (project, revision) } of its shared subprojects
+            self.commits = {}       # project -> { number of revision -> sha of commit }
+
+        def retrieve(self, revisions: List[MKS.Revision]):
+            """
+            Reads the shared subprojects of the revisions from MKS
+            """
+            with ThreadPoolExecutor(args.metadata_jobs) as executor:
+                for revision, subprojects in zip(revisions, executor.map(self.convert.mks.retrieve_shared_subprojects, revisions)):
+                    self.revisions[revision.number] = subprojects
+
+        def repository(self, project: str) -> str:
+            return os.path.join(self.directory, os.path.dirname(project).replace(":", "").strip("/").replace("/", "_"))
+
+        def convert_projects(self, convert: bool=True):
+            """
+            Converts the shared subprojects that are used by the revisions, or the checkpoints that are new since the
+            last run, and reads their commits. Without convert, only the commits of the earlier conversions are read.
+            """
+            projects = sorted(set([ project for subprojects in self.revisions.values() for project, _ in subprojects.values() ]))
+            arguments = sys.argv[1:]
+            arguments.reverse()
+            arguments.remove(args.pathToProject)
+            arguments.reverse()
+            for option in [ "shared_store", "submodules", "metadata_cache", "metrics", "profile" ]: # the conversion runs in another directory
+                if getattr(args, option): arguments += [ "--" + option.replace("_", "-"), os.path.abspath(getattr(args, option)) ] # the last one counts
+            for project in projects:
+                directory = self.repository(project)
+                if convert:
+                    Console.trace("Converting shared subproject %s into %s" % (project, directory))
+                    if not os.path.isdir(os.path.join(directory, ".git")):
+                        os.makedirs(directory, exist_ok=True)
+                        subprocess.run(["git", "init", "--quiet"], cwd=directory, check=True)
+                        subprocess.run(["git", "symbolic-ref", "HEAD", "refs/heads/main"], cwd=directory, check=True)
+                    with Metrics.span("convert submodule", project=project):
+                        exitcode = subprocess.run([sys.executable, os.path.abspath(sys.argv[0])] + arguments + [project], cwd=directory).returncode
+                    assert exitcode == 0, f"Conversion of shared subproject {project} failed"
+                self.commits[project] = {}
+                index_file = os.path.join(directory, ".git", "integrity2git", "revisions")
+                if not os.path.isfile(index_file): continue
+                for line in open(index_file, 'r'):
+                    number, sha = line.split()
+                    self.commits[project][number] = sha
+
+        def paths(self, revision: MKS.Revision) -> Dict[str, Tuple[str, str]]:
+            return self.revisions[revision.number]
+
+        def add(self, revision: MKS.Revision, files: Dict[str, list]) -> Dict[str, list]:
+            """
+            Returns the files with the gitlinks ([0, None, sha of commit, "160000"]) and .gitmodules instead of the files of the shared subprojects
+            """
+            subprojects = self.revisions[revision.number]
+            if not subprojects: return files
+            files = { path: entry for path, entry in files.items() if not Convert.is_within(path, subprojects) }
+            gitmodules = ""
+            for path, (project, number) in sorted(subprojects.items()):
+                sha = self.commits[project].get(number)
+                assert sha, f"Revision {number} of shared subproject {project} was not converted"
+                files[path] = [0, None, sha, "160000"]
+                gitmodules += '[submodule "%s"]\n\tpath = %s\n\turl = %s\n' % (path, path, convert_submodule_url(project, self.repository(project)))
+            data = gitmodules.encode("utf-8")
+            files[".gitmodules"] = [len(data), None, self.convert.git.export_blob(".gitmodules", len(data), [ data ])[1]]
+            return files
+
+    class Lfs:
+        """
+        Git LFS for --lfs-size and --lfs-pattern. The content of such a file is written once per SHA-256 into the LFS
+        object store of the repository and a pointer file is exported instead. The contents that are stored are listed
+        in the file lfs of the state directory, so they are neither read nor stored again.
+        """
+        def __init__(self, git: GitFastImport, lfs_dir: str):
+            self.git = git
+            self.objects_dir = os.path.join(lfs_dir, "objects")
+            self.tmp_dir = os.path.join(lfs_dir, "tmp")
+            self.index_file = os.path.join(git.state_dir, "lfs")
+            self.objects = {}       # sha of content -> (sha256 of content, size)
+            self.pointers = {}      # sha of content -> sha of pointer blob
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            if os.path.isfile(self.index_file):
+                for line in open(self.index_file, 'r'):
+                    sha, oid, size = line.split()
+                    self.objects[sha] = (oid, int(size))
+
+        patterns = {}           # pattern -> compiled regular expression
+
+        @staticmethod
+        def pattern_re(pattern: str):
+            """
+            Translates a pattern of .gitattributes to a regular expression: without a slash it matches the file name
+            in any directory, '*', '?' and [...] do not match a slash, '**/', '/**/' and '/**' match any directories
+            """
+            regex = Convert.Lfs.patterns.get(pattern)
+            if regex: return regex
+            parts = [ "(?:.*/)?" if "/" not in pattern else "" ]
+            glob = pattern[1:] if pattern.startswith("/") else pattern
+            i = 0
+            while i < len(glob):
+                if glob.startswith("**", i) and (i == 0 or glob[i - 1] == "/") and glob[i + 2:i + 3] in ("", "/"):
+                    parts.append(".*" if i + 2 == len(glob) else "(?:.*/)?")
+                    i += 3
+                    continue
+                c = glob[i]
+                end = i + 1
+                if c == "*":
+                    while glob.startswith("*", end): end += 1
+                    parts.append("[^/]*")
+                elif c == "?":
+                    parts.append("[^/]")
+                elif c == "[" and glob.find("]", i + (3 if glob[i + 1:i + 2] in ("!", "^") else 2)) > 0: # a ] right after [ is a member
+                    negated = glob[i + 1] in "!^"
+                    end = glob.find("]", i + (3 if negated else 2)) + 1
+                    members = "".join([ "\\" + m if m in "\\[]^" else m for m in glob[i + (2 if negated else 1):end - 1] ])
+                    parts.append("[^/" + members + "]" if negated else "(?!/)[" + members + "]")
+                elif c == "\\" and i + 1 < len(glob):
+                    parts.append(re.escape(glob[i + 1]))
+                    end = i + 2
+                else:
+                    parts.append(re.escape(c))
+                i = end
+            regex = Convert.Lfs.patterns[pattern] = re.compile("".join(parts) + r"\Z", re.DOTALL)
+            return regex
+
+        @staticmethod
+        def match(path: str, pattern: str) -> bool:
+            return Convert.Lfs.pattern_re(pattern).match(path) is not None
+
+        def matches(self, path: str, size: int) -> bool:
+            """
+            Whether a file is stored with Git LFS. Empty files are not, their pointer would be empty as well.
+            """
+            if size == 0: return False
+            if args.lfs_size is not None and size >= args.lfs_size*1024*1024: return True
+            return any([ Convert.Lfs.match(path, pattern) for pattern in args.lfs_pattern ])
+
+        def blob(self, sha: str) -> str:
+            """
+            Returns the mark of the pointer blob for a content, or None if the content is not stored yet
+            """
+            if sha not in self.objects: return None
+            if sha not in self.pointers:
+                pointer = ("version https://git-lfs.github.com/spec/v1\noid sha256:%s\nsize %d\n" % self.objects[sha]).encode("ascii")
+                self.pointers[sha] = self.git.export_blob("LFS pointer", len(pointer), [ pointer ])[1]
+            return self.git.blobs[self.pointers[sha]]
+
+        def export(self, name: str, size: int, chunks, sha: str=None) -> Tuple[str, str]:
+            """
+            Stores content of the given size, that is read from chunks, in the LFS object store. Returns the mark of the
+            pointer blob and the sha the content would have as git blob.
+            """
+            check = hashlib.sha1(b"blob %d\0" % size)
+            oid = hashlib.sha256()
+            length = 0
+            handle, tmp = tempfile.mkstemp(dir=self.tmp_dir)
+            try:
+                with os.fdopen(handle, 'wb') as f:
+                    for chunk in chunks:
+                        check.update(chunk)
+                        oid.update(chunk)
+                        length += len(chunk)
+                        f.write(chunk)
+                assert length == size, f"{name} changed its size while being exported"
+                blob_sha = check.hexdigest()
+                assert not sha or blob_sha == sha, f"{name} changed while being exported"
+                oid = oid.hexdigest()
+                object_file = os.path.join(self.objects_dir, oid[0:2], oid[2:4], oid)
+                if not os.path.isfile(object_file): # otherwise the same content is stored already
+                    os.makedirs(os.path.dirname(object_file), exist_ok=True)
+                    os.replace(tmp, object_file)
+                    Metrics.count("LFS objects stored")
+                    Metrics.count("LFS bytes stored", size)
+            finally:
+                if os.path.isfile(tmp): os.remove(tmp)
+            if blob_sha not in self.objects:
+                self.objects[blob_sha] = (oid, size)
+                with open(self.index_file, 'a') as f:
+                    f.write("%s %s %d\n" % (blob_sha, oid, size))
+            return self.blob(blob_sha), blob_sha
+
+        @staticmethod
+        def pattern(path: str) -> str:
+            # the path as pattern of .gitattributes: glob characters are escaped, a path with blanks is quoted
+            pattern = "/" + re.sub(r'([\\*?\[])', r'\\\1', path)
+            if re.search(r'[\s"]', pattern): pattern = '"' + pattern.replace('\\', '\\\\').replace('"', '\\"') + '"'
+            return pattern
+
+        def add_attributes(self, source, files: Dict[str, list]) -> Dict[str, list]:
+            """
+            Returns the files with a .gitattributes that assigns the patterns and the large files to Git LFS, after the
+            lines of the project's own .gitattributes
+            """
+            lines = [ "%s filter=lfs diff=lfs merge=lfs -text" % pattern for pattern in args.lfs_pattern ]
+            if args.lfs_size is not None:
+                limit = args.lfs_size*1024*1024
+                large = [ path for path, entry in files.items() if len(entry) == 3 and entry[0] >= limit and entry[0] > 0 ]
+                lines += [ "%s filter=lfs diff=lfs merge=lfs -text" % Convert.Lfs.pattern(path) for path in sorted(large)
+                           if not any([ Convert.Lfs.match(path, pattern) for pattern in args.lfs_pattern ]) ]
+            if not lines: return files
+            data = b""
+            if ".gitattributes" in files:
+                with open(source.filename(".gitattributes"), 'rb') as f:
+                    data = f.read()
+                if data and not data.endswith(b"\n"): data += b"\n"
+            data += ("\n".join(lines) + "\n").encode("utf-8")
+            files = dict(files) # the files of the sandbox keep the real .gitattributes
+            files[".gitattributes"] = [len(data), None, self.git.export_blob(".gitattributes", len(data), [ data ])[1]]
+            return files
+
+    @staticmethod
+    def is_within(path: str, directories) -> bool:
+        """
+        Whether the path is below one of the directories
+        """
+        while "/" in path:
+            path = path.rsplit("/", 1)[0]
+            if path in directories: return True
+        return False
 
-    def export_to_git(self, revisions, devpath: MKS.DevPath=None):
-        if len(revisions) == 0: return
+    @staticmethod
+    def branch_name(devpath: MKS.DevPath=None) -> str:
+        return "devpath/" + devpath.git_name if devpath else "main"
 
-        git_folder_re = re.compile("\.git(\\\|$)")  #any path named .git, with or without child elements. But will not match .gitignore
+    def manifest(self, devpath: MKS.DevPath=None) -> Manifest:
+        branch = Convert.branch_name(devpath)
+        if branch not in self.manifests:
+            self.manifests[branch] = Convert.Manifest(os.path.join(self.state_dir, "manifests", branch + ".json"))
+        return self.manifests[branch]
 
-        if revisions[0].ancestor: ancestor = revisions[0].ancestor
-        elif devpath: ancestor = devpath.ancestor
-        else: ancestor = None
+    @staticmethod
+    def hash_file(filename: str, size: int) -> str:
+        """
+        Calculates the git blob id of a file
+        """
+        sha = hashlib.sha1(b"blob %d\0" % size)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
 
-        for revision in revisions:
-            Console.step()
+    git_folder_re = re.compile("\.git(/|$)")  #any path named .git, with or without child elements. But will not match .gitignore
 
-            mark = self.marks[revision.number]
+    def is_excluded(self, path: str) -> bool:
+        """
+        Whether a file of the sandbox is not exported to git
+        """
+        if '.pj' in path: return True
+        if Convert.git_folder_re.search(path): return True
+        if 'mks_checkpoints_to_git' in path: return True
+        return False
 
-            self.mks.retarget_to(revision)
+    def scan_sandbox(self, sandbox: Sandbox, skip=()) -> Dict[str, list]:
+        """
+        Returns path -> [size, mtime, sha] of all files in the sandbox that are exported, except those in the skipped
+        directories. The sha of a file whose size or mtime changed since the last scan is None, it is calculated when
+        the file is exported.
+        """
+        scanned = Stage("tree scanner", 1024)
 
-            if devpath: self.git.command('commit refs/heads/devpath/%s' % devpath.git_name)
-            else:       self.git.command('commit refs/heads/main')
-            self.git.command('mark %s' % mark)
-            self.git.command('committer %s <> %d +0000' % (revision.author, revision.seconds))
-            self.git.export_string(revision.description)
-            if ancestor:
-                self.git.command('from %s' % self.marks[ancestor.number]) # we're starting a development path so we need to start from where it was originally branched from
-                ancestor = None #set to zero so it doesn't loop back in to here
-            self.git.command('deleteall')
-            tree = os.walk('.')
-            for dir in tree:
-                for filename in dir[2]:
-                    if (dir[0] == '.'):
-                        fullfile = filename
+        def scan(): # walks the tree in a separate thread, so the file system is busy while the entries are compared
+            try:
+                for dir in os.walk(sandbox.path):
+                    relative_dir = os.path.relpath(dir[0], sandbox.path).replace('\\', '/')
+                    if skip: dir[1][:] = [ d for d in dir[1] if (d if relative_dir == '.' else relative_dir + '/' + d) not in skip ]
+                    for filename in dir[2]:
+                        if (relative_dir == '.'):
+                            fullfile = filename
+                        else:
+                            fullfile = relative_dir + '/' + filename
+                        if self.is_excluded(fullfile): continue
+                        filename = os.path.join(dir[0], filename)
+                        scanned.put((fullfile, filename, os.stat(filename)))
+                scanned.put(None)
+            except Stage.Closed:
+                pass
+            except Exception as ex:
+                scanned.put(ex)
+        threading.Thread(target=scan, daemon=True).start()
+
+        files = {}
+        changed = 0
+        try:
+            while True:
+                item = scanned.get()
+                if item is None: break
+                if isinstance(item, Exception): raise item
+                fullfile, filename, stat = item
+                cached = sandbox.files.get(fullfile)
+                if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                    files[fullfile] = cached
+                else:
+                    files[fullfile] = [stat.st_size, stat.st_mtime_ns, None]
+                    changed += 1
+        finally:
+            scanned.close()
+        Metrics.count("files scanned", len(files))
+        Metrics.count("files changed in sandbox", changed + len([ path for path in sandbox.files if path not in files ]))
+        sandbox.files = files
+        return files
+
+    def prepare_sandbox(self, revision: MKS.Revision, sandbox: Sandbox) -> Dict[str, list]:
+        """
+        Brings the sandbox to the revision and scans its files
+        """
+        if os.path.isdir(sandbox.path):
+            self.mks.retarget_to(revision, sandbox.path)
+        else:
+            self.mks.create_sandbox(revision, sandbox.path)
+        with Metrics.span("tree walk", revision=revision.number):
+            return self.scan_sandbox(sandbox, self.submodules.paths(revision) if self.submodules else ())
+
+    def prepare_sandboxes(self, checkpoints: list):
+        """
+        Prepares the sandboxes for the upcoming checkpoints concurrently and yields (checkpoint, sandbox, files)
+        in the order of the checkpoints. A sandbox is not used for another checkpoint until the consumer asks
+        for the next checkpoint, so the files of the yielded sandbox can still be read.
+        """
+        free_sandboxes = queue.Queue()
+        for sandbox in self.sandboxes: free_sandboxes.put(sandbox)
+        prepared = queue.Queue()    # holds at most one entry per sandbox
+        executor = ThreadPoolExecutor(len(self.sandboxes))
+
+        def dispatch(): # hands out the sandboxes in the order of the checkpoints, so the oldest checkpoint can always proceed
+            for checkpoint in checkpoints:
+                sandbox = free_sandboxes.get()
+                if sandbox is None: return
+                prepared.put((checkpoint, sandbox, executor.submit(self.prepare_sandbox, checkpoint[0], sandbox)))
+        dispatcher = threading.Thread(target=dispatch, daemon=True)
+        dispatcher.start()
+
+        try:
+            for i in range(len(checkpoints)):
+                checkpoint, sandbox, future = prepared.get()
+                yield checkpoint, sandbox, future.result()
+                free_sandboxes.put(sandbox)
+        finally:
+            free_sandboxes.put(None) # stops the dispatcher in case of an error
+            executor.shutdown(wait=False)
+
+    def prepare_members(self, checkpoints: list):
+        """
+        Yields (checkpoint, member tree, files) in the order of the checkpoints, after fetching all member revisions
+        that are not in the cache yet
+        """
+        executor = ThreadPoolExecutor(args.sandboxes)
+        try:
+            for checkpoint in checkpoints:
+                revision = checkpoint[0]
+                skip = self.submodules.paths(revision) if self.submodules else ()
+                members = { path: member for path, member in self.mks.retrieve_members(revision).items() if not self.is_excluded(path) and not Convert.is_within(path, skip) }
+                missing = { member: path for path, member in members.items() if member not in self.member_cache.index } # each member once
+                for future in [ executor.submit(self.member_cache.fetch, self.mks, revision, path, member) for member, path in missing.items() ]:
+                    future.result()
+                files = {}
+                for path, member in members.items():
+                    size, sha = self.member_cache.index[member]
+                    files[path] = [size, None, sha]
+                yield checkpoint, Convert.MemberTree(self, revision, members), files
+        finally:
+            executor.shutdown(wait=False)
+
+    def drop_sandboxes(self):
+        for sandbox in self.sandboxes:
+            if os.path.isdir(sandbox.path):
+                self.mks.drop_sandbox(sandbox.path)
+        if len(self.sandboxes) > 1 and os.path.isdir(self.mks.sandboxPath) and not os.listdir(self.mks.sandboxPath):
+            os.rmdir(self.mks.sandboxPath)
+
+    @staticmethod
+    def changed_files(old_files: Dict[str, list], new_files: Dict[str, list]) -> Tuple[List[str], List[str]]:
+        """
+        Returns the removed and the added or possibly modified (sha is None) paths that turn old_files into new_files
+        """
+        removed = [ path for path in old_files if path not in new_files ]
+        modified = [ path for path, entry in new_files.items() if path not in old_files or entry[2] is None or old_files[path][2] != entry[2] ]
+        return removed, modified
+
+    @staticmethod
+    def order_checkpoints(branches: List[Tuple[List[MKS.Revision], MKS.DevPath]], depth_first: bool) -> list:
+        """
+        Returns (revision, devpath, parent revision) of the revisions of all branches, either one branch after the other
+        or depth-first, i.e. each branch right after the revision it starts from, so the sandbox only moves a few
+        checkpoints between two exports
+        """
+        starts = {}     # number of Revision -> branches that start from it
+        roots = []      # branches that start from a revision that is not exported now
+        numbers = set([ revision.number for revisions, devpath in branches for revision in revisions ])
+        for revisions, devpath in branches:
+            if len(revisions) == 0: continue
+
+            if revisions[0].ancestor: parent = revisions[0].ancestor
+            elif devpath: parent = devpath.ancestor
+            else: parent = None
+
+            if depth_first and parent and parent.number in numbers:
+                starts.setdefault(parent.number, []).append((revisions, devpath, parent))
+            else:
+                roots.append((revisions, devpath, parent))
+
+        checkpoints = []
+        def add(revisions, devpath, parent):
+            for revision in revisions:
+                checkpoints.append((revision, devpath, parent))
+                parent = revision
+                for branch in starts.get(revision.number, []): add(*branch)
+        for branch in roots: add(*branch)
+        return checkpoints
+
+    @staticmethod
+    def retarget_distance(checkpoints: list, sandboxes: int) -> int:
+        """
+        Estimates how far the sandboxes have to move for the checkpoints: the number of checkpoints between the
+        revisions that follow each other in a sandbox, if the sandboxes are used in turn
+        """
+        parents = {}
+        depths = {}
+        for revision, devpath, parent in checkpoints:
+            parents[revision.number] = parent.number if parent else None
+            depths[revision.number] = depths.get(parents[revision.number], 0) + 1 if parent else 1
+
+        def distance(a: str, b: str) -> int:
+            steps = 0
+            while a != b:
+                if a is None and b is None: break # not connected by the exported revisions
+                if b is None or (a is not None and depths.get(a, 0) >= depths.get(b, 0)): a = parents.get(a)
+                else: b = parents.get(b)
+                steps += 1
+            return steps
+
+        numbers = [ checkpoint[0].number for checkpoint in checkpoints ]
+        return sum([ distance(numbers[i - sandboxes], numbers[i]) for i in range(sandboxes, len(numbers)) ])
+
+    def export_to_git(self, branches: List[Tuple[List[MKS.Revision], MKS.DevPath]]):
+        """
+        Exports the revisions of all branches, each branch as [revisions, devpath], in the order of args.order
+        """
+        checkpoints = Convert.order_checkpoints(branches, args.order == "depth-first")
+        if len(checkpoints) == 0: return
+        if not args.member_mode:
+            distance = Convert.retarget_distance(checkpoints, len(self.sandboxes))
+            if args.order != "branches":
+                Console.trace("Retarget distance: %d checkpoints instead of %d" % (distance, Convert.retarget_distance(Convert.order_checkpoints(branches, False), len(self.sandboxes))))
+            else:
+                Console.trace("Retarget distance: %d checkpoints" % distance)
+            Metrics.count("retarget distance", distance)
+
+        if self.submodules:
+            Console.trace("Retrieving shared subprojects")
+            self.submodules.retrieve([ checkpoint[0] for checkpoint in checkpoints ])
+            self.submodules.convert_projects()
+
+        if args.member_mode:
+            prepared = self.prepare_members(checkpoints)
+        else:
+            for sandbox in self.sandboxes:
+                sandbox.files = self.manifest(checkpoints[0][1]).files
+            prepared = self.prepare_sandboxes(checkpoints)
+
+        # the manifest of a branch is dropped after its last checkpoint, or after the last branch that starts from it
+        last = {}       # git branch name -> index of its last checkpoint, or of the last checkpoint that starts from its tip
+        starts = {}     # number of Revision -> index of the last checkpoint that starts a branch from it
+        for i, (revision, devpath, parent) in enumerate(checkpoints):
+            branch = Convert.branch_name(devpath)
+            if parent and branch not in last: starts[parent.number] = i
+            last[branch] = i
+        drops = {}      # index of checkpoint -> git branch names that are finished after it
+        for branch, i in last.items():
+            drops.setdefault(max(i, starts.get(checkpoints[i][0].number, i)), []).append(branch)
+
+        for i, ((revision, devpath, parent), source, files) in enumerate(prepared):
+            if self.submodules: files = self.submodules.add(revision, files)
+            if self.lfs: files = self.lfs.add_attributes(source, files)
+            with Metrics.span("export revision", revision=revision.number):
+                self.export_revision(revision, devpath, parent, source, files)
+            Console.step()
+            Stage.report_if_due()
+            self.finished += drops.get(i, [])
+            if i + 1 == len(checkpoints) or (args.order == "branches" and checkpoints[i + 1][1] != devpath): # end of branch
+                self.checkpoint()
+            elif len(self.unindexed) >= args.checkpoint_every or self.git.bytes_sent - self.checkpoint_bytes >= args.checkpoint_size*1024*1024:
+                self.checkpoint()
+        Stage.report()
+        Console.trace("%0.1f MB sent to git fast-import" % (self.git.bytes_sent / 1024 / 1024))
+        Metrics.count("bytes sent to git fast-import", self.git.bytes_sent)
+
+    def known_blob(self, path: str, entry: list) -> str:
+        """
+        Returns the mark of the blob for a file whose content was sent to git before, otherwise None
+        """
+        if self.lfs and self.lfs.matches(path, entry[0]): return self.lfs.blob(entry[2])
+        return self.git.blobs.get(entry[2])
+
+    def export_revision(self, revision: MKS.Revision, devpath: MKS.DevPath, parent: MKS.Revision, source, files: Dict[str, list]):
+        """
+        Writes the commit of a revision, reading the content of the files from source (Sandbox or MemberTree)
+        """
+        branch = Convert.branch_name(devpath)
+        manifest = self.manifest(devpath)
+        mark = self.marks[revision.number]
+
+        # a new branch starts from the manifest of the branch that is at the parent, e.g. with --order depth-first
+        base = manifest if not parent or manifest.revision == parent.number else next((m for m in self.manifests.values() if m.revision == parent.number), manifest)
+        if parent and base.revision == parent.number:
+            removed, modified = Convert.changed_files(base.files, files)
+        else: # no manifest describes the parent commit, so write the whole tree
+            removed, modified = None, list(files)
+        exported = []
+        unknown = [ path for path in modified if len(files[path]) == 3 and not self.known_blob(path, files[path]) ]
+        reader = Convert.FileReader(source, unknown)
+        unknown = set(unknown)
+        try:
+            for path in modified:
+                entry = files[path]
+                with Metrics.span("export file", record=False):
+                    if len(entry) > 3: # gitlink to the commit of a submodule
+                        blob = entry[2]
+                    elif path not in unknown:
+                        blob = self.known_blob(path, entry)
                     else:
-                        fullfile = os.path.join(dir[0], filename)[2:]
-                    if '.pj' in fullfile: continue
-                    if git_folder_re.search(fullfile): continue
-                    if 'mks_checkpoints_to_git' in fullfile: continue
-                    self.git.export_file(fullfile)
+                        content = reader.chunks()
+                        if self.lfs and self.lfs.matches(path, entry[0]):
+                            blob, entry[2] = self.lfs.export(path, entry[0], content, entry[2])
+                        else:
+                            blob, entry[2] = self.git.export_blob(path, entry[0], content, entry[2])
+                        for chunk in content: pass # a blob that is sent already is not read completely
+                        Metrics.count("bytes read", entry[0])
+                if removed is None or base.files.get(path, [None] * 3)[2] != entry[2]: # otherwise only the mtime changed
+                    exported.append((path, blob, entry[3] if len(entry) > 3 else '644'))
+        finally:
+            reader.close()
+
+        # a changed directory whose tree git has already (e.g. the unchanged directories when the whole tree is
+        # written, or a directory that is reverted) is written as a reference to that tree instead of its files
+        if removed is None or base.trees is None:
+            trees = Convert.hash_trees(files, self.tree_entry)
+        else:
+            trees = Convert.hash_trees(files, self.tree_entry, base.trees, removed + modified)
+        previous = base.trees if removed is not None and base.trees is not None else {}
+        changed = [ dir for dir, tree in trees.items() if tree != previous.get(dir) ]
+        reused = {}     # directory -> id of its tree
+        within = lambda path: "" in reused or Convert.is_within(path, reused)
+        for dir in sorted([ dir for dir in changed if trees[dir] in self.trees ], key=lambda dir: dir.count("/") if dir else -1):
+            if not within(dir): reused[dir] = trees[dir]
+        if reused:
+            exported = [ file for file in exported if not within(file[0]) ]
+            if removed: removed = [ path for path in removed if not within(path) ]
+
+        self.git.command('commit refs/heads/%s' % branch)
+        self.git.command('mark %s' % mark)
+        self.git.command('committer %s <> %d +0000' % (revision.author, revision.seconds))
+        self.git.export_string(revision.description)
+        if parent and self.branch_tips.get(branch) != parent:
+            self.git.command('from %s' % self.marks[parent.number]) # we're starting or continuing a branch, so we need to start from where it was originally branched from
+        if removed is None:
+            self.git.command('deleteall')
+        else:
+            for path in removed: self.git.command('D %s' % path)
+        for dir, tree in reused.items():
+            self.git.export_file(dir or '""', tree, mode='040000')
+        for path, blob, mode in exported:
+            self.git.export_file(path, blob, mode=mode)
+        Metrics.count("files exported", len(exported))
+        Metrics.count("trees reused", len(reused))
+        manifest.revision = revision.number
+        manifest.files = files
+        manifest.trees = trees
+        manifest.dirty = True
+        new_trees = set([ trees[dir] for dir in changed ]) - self.trees
+        self.trees.update(new_trees)
+        self.new_trees.extend(new_trees)
+        self.branch_tips[branch] = revision
+        self.unindexed.append(revision.number)
+
+        for tag in revision.tags:
+            self.git.command('tag %s' % tag.git_name)
+            self.git.command('from %s' % mark)
+            self.git.command('tagger %s <> %d +0000' % (revision.author, revision.seconds))
+            self.git.export_string("") # Tag message
+
+    def checkpoint(self):
+        """
+        Lets git fast-import persist its data, then stores the commits of the revisions and the manifests of the branches.
+        The revisions are written to a journal first, so they can be indexed on the next run if this one stops before.
+        """
+        with open(self.journal_file, 'w') as f:
+            for number in self.unindexed:
+                f.write("%s %s\n" % (number, self.marks[number]))
+        self.git.checkpoint()
+        marks = self.git.read_marks()
+        self.add_to_revision_index(self.revision_index, [ (number, marks[self.marks[number]]) for number in self.unindexed ])
+        os.remove(self.journal_file)
+        self.unindexed = []
+        with open(self.trees_file, 'a') as f:
+            for tree in self.new_trees: f.write(tree + "\n")
+        self.new_trees = []
+        self.checkpoint_bytes = self.git.bytes_sent
+        for manifest in self.manifests.values():
+            if manifest.dirty:
+                manifest.save()
+                Metrics.count("manifests saved")
+        for branch in self.finished: # a manifest is loaded again when it is needed
+            self.manifests.pop(branch, None)
+        self.finished = []
 
-            for tag in revision.tags:
-                self.git.command('tag %s' % tag.git_name)
-                self.git.command('from %s' % mark)
-                self.git.command('tagger %s <> %d +0000' % (revision.author, revision.seconds))
-                self.git.export_string("") # Tag message
-
-        self.git.command('checkpoint')
-
-    def find_continuation_point(self, done_count: int, revisions: List[MKS.Revision]) -> Tuple[int, List[MKS.Revision]]:
-        if not self.repo.head.is_valid(): return done_count, revisions
-        last_commit_date = self.repo.head.commit.committed_date
-        revisions2 = [r for r in revisions if r.seconds > last_commit_date]
-        done_count += len(revisions) - len(revisions2)
-        if len(revisions2) > 0:
-            revisions2[0].ancestor = revisions[len(revisions) - len(revisions2)-1]
+    @staticmethod
+    def hash_trees(files: Dict[str, list], tree_entry=lambda path, entry: entry, trees: Dict[str, str]=None, changed: List[str]=None) -> Dict[str, str]:
+        """
+        Calculates the git tree ids of all directories ("" is the root) of path -> entry, with tree_entry returning
+        the mode and the sha of blob or commit of an entry. Given the tree ids of a previous state and the paths that
+        changed since, only the directories of these paths are calculated again.
+        """
+        dirty = None    # directories to calculate, None for all
+        if trees is not None:
+            dirty = set()
+            for path in changed:
+                while path:
+                    path = path.rpartition("/")[0]
+                    if path in dirty: break
+                    dirty.add(path)
+            trees = { dir: tree for dir, tree in trees.items() if dir not in dirty }
+        else:
+            trees = {}
+
+        listing = {}    # directory -> name -> (mode, sha) of a file, or None for a directory
+        for path, entry in files.items():
+            dir, _, name = path.rpartition("/")
+            if dirty is not None and dir not in dirty: continue
+            listing.setdefault(dir, {})[name] = tree_entry(path, entry)
+            while dir:
+                parent, _, name = dir.rpartition("/")
+                if name in listing.setdefault(parent, {}): break
+                listing[parent][name] = None
+                dir = parent
+        if dirty is not None:
+            for dir in trees: # the unchanged directories in the changed ones
+                parent, _, name = dir.rpartition("/")
+                if dir and parent in dirty: listing.setdefault(parent, {})[name] = None
+
+        for dir in sorted(listing, key=lambda dir: -dir.count("/") if dir else 1): # the root last
+            entries = []
+            for name, entry in listing[dir].items():
+                name = name.encode("utf-8")
+                if entry is None:
+                    tree = trees[(dir + "/" if dir else "") + name.decode("utf-8")]
+                    entries.append((name + b"/", b"40000 " + name + b"\0" + bytes.fromhex(tree))) # git sorts a tree as if its name ended with /
+                else:
+                    entries.append((name, entry[0].encode("ascii") + b" " + name + b"\0" + bytes.fromhex(entry[1] or "0" * 40)))
+            data = b"".join([ entry[1] for entry in sorted(entries) ])
+            trees[dir] = hashlib.sha1(b"tree %d\0" % len(data) + data).hexdigest()
+        return trees
+
+    @staticmethod
+    def hash_tree(files: Dict[str, Tuple[str, str]]) -> str:
+        """
+        Calculates the git tree id of path -> (mode, sha of blob or commit)
+        """
+        return Convert.hash_trees(files).get("", "4b825dc642cb6eb9a060e54bf8d69288fbee4904") # the empty tree
+
+    def tree_entry(self, path: str, entry: list) -> Tuple[str, str]:
+        """
+        Returns the mode and the sha of a file as it is exported to git
+        """
+        if len(entry) > 3: return entry[3], entry[2]
+        if self.lfs and self.lfs.matches(path, entry[0]):
+            self.lfs.blob(entry[2])
+            return "100644", self.lfs.pointers.get(entry[2]) # None if the content was not stored
+        return "100644", entry[2]
+
+    def verify(self, branches: List[Tuple[List[MKS.Revision], MKS.DevPath]]) -> bool:
+        """
+        Compares the trees of the converted revisions (or of args.verify_sample of them) with the content of the
+        revisions in MKS, without a checkout. The files whose sha is not known yet are hashed in parallel.
+        Returns whether all trees are equal.
+        """
+        checkpoints = [ checkpoint for checkpoint in Convert.order_checkpoints(branches, args.order == "depth-first") if checkpoint[0].number in self.revision_index ]
+        if 0 < args.verify_sample < len(checkpoints):
+            sample = set(random.sample(range(len(checkpoints)), args.verify_sample))
+            checkpoints = [ checkpoint for i, checkpoint in enumerate(checkpoints) if i in sample ]
+        Console.trace("Verifying %d revisions" % len(checkpoints))
+        if len(checkpoints) == 0: return True
+        Console.set_total_steps(len(checkpoints))
+        if self.submodules:
+            self.submodules.retrieve([ checkpoint[0] for checkpoint in checkpoints ])
+            self.submodules.convert_projects(convert=False)
+        prepared = self.prepare_members(checkpoints) if args.member_mode else self.prepare_sandboxes(checkpoints)
+
+        failed = []
+        with ThreadPoolExecutor(os.cpu_count()) as executor: # hashlib releases the GIL while it hashes
+            for (revision, devpath, parent), source, files in prepared:
+                with Metrics.span("verify revision", revision=revision.number):
+                    unknown = [ path for path, entry in files.items() if entry[2] is None ]
+                    for path, sha in zip(unknown, executor.map(lambda path: Convert.hash_file(source.filename(path), files[path][0]), unknown)):
+                        files[path][2] = sha
+                    Metrics.count("files hashed", len(unknown))
+                    if self.submodules: files = self.submodules.add(revision, files)
+                    if self.lfs: files = self.lfs.add_attributes(source, files)
+                    expected = { path: self.tree_entry(path, entry) for path, entry in files.items() }
+                    tree = self.repo.commit(self.revision_index[revision.number]).tree
+                    if Convert.hash_tree(expected) != tree.hexsha:
+                        failed.append(revision.number)
+                        self.report_differences(revision, expected, tree)
+                Console.step()
+        if failed: Console.error("%d of %d revisions differ: %s" % (len(failed), len(checkpoints), ", ".join(failed)))
+        else: Console.trace("All %d revisions are equal" % len(checkpoints))
+        return not failed
+
+    def report_differences(self, revision: MKS.Revision, expected: Dict[str, Tuple[str, str]], tree):
+        actual = { item.path: ("%o" % item.mode, item.hexsha) for item in tree.traverse() if item.type != "tree" }
+        for path in sorted(set(expected) | set(actual)):
+            if path not in actual:
+                Console.error(f"Revision {revision.number}: {path} is missing in git")
+            elif path not in expected:
+                Console.error(f"Revision {revision.number}: {path} is not in MKS")
+            elif actual[path] != expected[path]:
+                Console.error(f"Revision {revision.number}: {path} differs")
+
+    def converted_count(self, revisions: List[MKS.Revision]) -> int:
+        """
+        Returns how many revisions at the beginning of the list were already converted
+        """
+        for i in range(len(revisions) - 1, -1, -1):
+            if revisions[i].number in self.revision_index: return i + 1
+        return 0
+
+    def index_by_date(self, revisions: List[MKS.Revision]):
+        """
+        Adds revisions converted by an older version of this script to the revision index, by finding the commits by date
+        """
+        if not hasattr(self, "commits_by_date"):
+            Console.trace("Indexing the commits of an older conversion")
+            self.commits_by_date = {}
+            for commit in self.repo.iter_commits("--all"):
+                self.commits_by_date.setdefault(commit.committed_date, set()).add(commit.hexsha)
+        entries = []
+        for revision in revisions:
+            commits = self.commits_by_date.get(revision.seconds, set())
+            if len(commits) == 1 and revision.number not in self.revision_index:
+                entries.append((revision.number, next(iter(commits))))
+            elif len(commits) > 1:
+                Console.error(f"Multiple commits found for revision {revision.number}: " + ", ".join(commits))
+        self.add_to_revision_index(self.revision_index, entries)
+
+    def find_continuation_point(self, done_count: int, revisions: List[MKS.Revision], branch: str="main") -> Tuple[int, List[MKS.Revision]]:
+        if self.legacy_resume:
+            commits = [ b.commit for b in self.repo.branches if b.path == "refs/heads/" + branch ]
+            if commits: self.index_by_date([r for r in revisions if r.seconds <= commits[0].committed_date])
+        done = self.converted_count(revisions)
+        revisions2 = revisions[done:]
+        done_count += done
+        if len(revisions2) > 0 and done > 0:
+            revisions2[0].ancestor = revisions[done - 1]
         return done_count, revisions2
 
     def find_continuation_point_devpath(self, done_count: int, devpath: MKS.DevPath) -> int:
-        branch = [ b for b in self.repo.branches if b.path == "refs/heads/devpath/" + devpath.git_name]
-        if len(branch) == 0: return done_count
-        last_commit_date = branch[0].commit.committed_date
-        revisions2 = [r for r in devpath.revisions if r.seconds > last_commit_date]
-        done_count += len(devpath.revisions) - len(revisions2)
-        if len(revisions2) > 0:
-            revisions2[0].ancestor = devpath.revisions[len(devpath.revisions) - len(revisions2)-1]
-        devpath.revisions = revisions2
+        done_count, devpath.revisions = self.find_continuation_point(done_count, devpath.revisions, Convert.branch_name(devpath))
         return done_count
 
     def create_marks(self, master_revisions : List[MKS.Revision], devpaths : List[MKS.DevPath]):
-        def convert_revision_to_mark(revision : MKS.Revision, allowNew, date=False):
+        def convert_revision_to_mark(revision : MKS.Revision, allowNew):
             if revision.number in self.marks:
                 return self.marks[revision.number]
 
             if allowNew:
-                mark = ":" + str(len(self.marks)+1)
+                mark = self.git.new_mark()
                 self.marks[revision.number] = mark
                 return mark
             else:
-                assert date, "No date given, cannot find commit"
-                date = datetime.strftime(datetime.fromtimestamp(date), args.date_format)
-                commits = [c for c in self.repo.iter_commits("--all", before=date, after=date)]
-                if len(commits) == 0: assert len(commits) == 1, "No commit found for date " + date
-                assert len(commits) == 1, f"Multiple commits found for date {date}: " + ", ".join([c.hexsha for c in commits])
-                self.marks[revision.number] = commits[0].hexsha
-                return commits[0].hexsha
+                assert revision.number in self.revision_index, f"No commit found for revision {revision.number}"
+                self.marks[revision.number] = self.revision_index[revision.number]
+                return self.marks[revision.number]
 
         if len(master_revisions) > 0:
             if master_revisions[0].ancestor: # we are continuing master
-                convert_revision_to_mark(master_revisions[0].ancestor, allowNew=False, date=master_revisions[0].ancestor.seconds)
+                convert_revision_to_mark(master_revisions[0].ancestor, allowNew=False)
             for revision in master_revisions:
                 convert_revision_to_mark(revision, allowNew=True)
         for devpath in devpaths:
-            convert_revision_to_mark(devpath.ancestor, allowNew=False, date=devpath.ancestor.seconds)
+            convert_revision_to_mark(devpath.ancestor, allowNew=False)
             if devpath.revisions and devpath.revisions[0].ancestor: # we are continuing branch
-                convert_revision_to_mark(devpath.revisions[0].ancestor, allowNew=False, date=devpath.revisions[0].ancestor.seconds)
+                convert_revision_to_mark(devpath.revisions[0].ancestor, allowNew=False)
             for revision in devpath.revisions:
                 convert_revision_to_mark(revision, allowNew=True)
 
 
+    @staticmethod
+    def is_filesystem_case_sensitive() -> bool:
+        tmphandle, tmppath = tempfile.mkstemp()
+        case_sensitive = not os.path.exists(tmppath.upper())
+        os.close(tmphandle)
+        os.remove(tmppath)
+        return case_sensitive
+
     def check_tags_for_uniqueness(self, all_revisions: List[MKS.Revision]):
         """
         Check whether all tags of all revisions are unique, possibly case insensitive
         """
-        def is_filesystem_case_sensitive():
-            tmphandle, tmppath = tempfile.mkstemp()
-            case_sensitive = not os.path.exists(tmppath.upper())
-            os.close(tmphandle)
-            os.remove(tmppath)
-            return case_sensitive
-        case_sensitive = is_filesystem_case_sensitive()
-
-        class RevisionInfo:
-            def __init__(self, revision, tag):
-                self.revision = revision
-                self.tag = tag
+        case_sensitive = Convert.is_filesystem_case_sensitive()
 
-        tags = {}
+        tags = {}       # git name of tag, lower case if the file system is not case sensitive -> [(revision, tag)]
         for revision in all_revisions:
             for tag in revision.tags:
                 tagL = tag.git_name if case_sensitive else tag.git_name.lower()
-                tags.setdefault(tagL, []).append(RevisionInfo(revision, tag))
+                tags.setdefault(tagL, []).append((revision, tag))
 
         error = False
         for tag, revisions in tags.items():
             if len(revisions) > 1:
                 error = True
                 if not case_sensitive:
-                    Console.error(f"{len(revisions)} revisions found for tag {tag}: " + ", ".join([ f"{ri.revision.number} ({ri.tag.git_name})" for ri in revisions ]))
+                    Console.error(f"{len(revisions)} revisions found for tag {tag}: " + ", ".join([ f"{revision.number} ({t.git_name})" for revision, t in revisions ]))
                     Console.error("This error is raised to avoid problems with a case-insensitive file system (see README)")
                 else:
-                    Console.error(f"{len(revisions)} revisions found for tag {tag.git_name}: " + ", ".join([ ri.revision.number for ri in revisions ]))
+                    Console.error(f"{len(revisions)} revisions found for tag {tag}: " + ", ".join([ revision.number for revision, t in revisions ]))
         assert not error, "duplicate tags"
 
-    def check_branch_tag_names(self, names: List[str], type: str):
+    # the rules of git check-ref-format (check_refname_format in refs.c) for a full name like refs/tags/<name>:
+    # at least two components, no empty component, no component beginning with '.' or ending with '.lock',
+    # no '..', no '@{', no control characters, blanks or any of ~^:?*[\, and no '.' at the end
+    invalid_ref_re = re.compile(r'^[^/]*$|^/|//|/$|(^|/)\.|\.\.|\.lock(/|$)|\.$|@\{|[\000-\040\177~^:?*[\\]')
+    # Windows cannot store refs as files with these characters, components ending with '.' or reserved device names
+    invalid_windows_ref_re = re.compile(r'[<>"|]|\.(/|$)|(^|/)(CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9])(\.[^/]*)?(/|$)', re.IGNORECASE)
+
+    @staticmethod
+    def ref_name_errors(ref: str, windows: bool=False) -> List[str]:
         """
-        Check the name of a branch or a tag for git compliance
+        Returns why the full name of a ref is invalid, empty if it is valid
         """
-        def git_check(name: str):
-            process = subprocess.Popen(["git", "check-ref-format", "--branch", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            exit_status = process.wait()
-            return exit_status == 0
-
-        def begins_width_dot(name: str):
-            for part in name.split("/"):
-                if part.startswith("."): return "Begins with '.'"
-            return None
-        def ends_with_lock(name: str):
-            if name.endswith(".lock"): return "Ends with '.lock'"
-            return None
-        def ends_with_dot(name: str):
-            if name.endswith("."): return "Ends with '.'"
-            return None
-        def dot_dot(name: str):
-            if ".." in name: return "Contains '..'"
-            return None
-        def backslash(name: str):
-            if "\\" in name: return "Contains '\\'"
-            return None
-        def at_brace(name: str):
-            if "@{" in name: return "Contains '@{'"
-        def invalid_chars(name: str):
-            invalids = set(re.compile("[\000-\037\177 ~^:?*[]").findall(name))
-            if invalids: return "Contains any of '" + "".join(invalids) + "'"
-            return None
-        def at(name: str):
-            if name == "@": return "It's simply @"
-            return None
-
-        checks = [begins_width_dot, ends_with_lock, ends_with_dot, dot_dot, backslash, at_brace, invalid_chars, at]
+        checks = [ (r'^[^/]*$', "Has only one component"),
+                   (r'^/|//|/$', "Has an empty component"),
+                   (r'(^|/)\.', "Begins with '.'"),
+                   (r'\.lock(/|$)', "Ends with '.lock'"),
+                   (r'\.\.', "Contains '..'"),
+                   (r'\.$', "Ends with '.'"),
+                   (r'@\{', "Contains '@{'"),
+                   (r'\\', "Contains '\\'") ]
+        if windows:
+            checks += [ (r'\./', "A component ends with '.' on Windows"),
+                        (r'(?i)(^|/)(CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9])(\.[^/]*)?(/|$)', "Is a reserved name on Windows") ]
+        errors = [ message for pattern, message in checks if re.search(pattern, ref) ]
+        invalids = sorted(set(re.findall(r'[\000-\040\177~^:?*[<>"|]' if windows else r'[\000-\040\177~^:?*[]', ref)))
+        if invalids: errors.append("Contains any of '" + "".join(invalids) + "'")
+        return errors
 
-        any_error = False
-        for name in names:
-            #if git_check(name): continue # takes too much time
-            errors = []
-            for check in checks:
-                errors.append(check(name))
-            errors = [ e for e in errors if e ]
-            if errors:
-                any_error = True
-                Console.error(f"{type} name '{name}' is invalid: " + ", ".join(errors))
-        assert not any_error, f"{type} names are incorrect"
-
-
-
-
-git = GitFastImport()
+    @staticmethod
+    def fix_ref_name(name: str) -> str:
+        """
+        Returns a similar name for a branch or tag that git accepts, also on Windows
+        """
+        name = re.sub(r'[\000-\040\177~^:?*[\\<>"|]', "_", name).replace("@{", "@_")
+        name = re.sub(r'\.\.+', ".", name)
+        parts = []
+        for part in name.split("/"):
+            if not part: continue
+            if part.startswith("."): part = "_" + part[1:]
+            if part.endswith(".lock"): part = part[:-len(".lock")] + "_lock"
+            if part.endswith("."): part = part[:-1] + "_"
+            if re.match(r'(CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9])(\.|$)', part, re.IGNORECASE): part = "_" + part
+            parts.append(part)
+        return "/".join(parts) or "_"
+
+    def fix_ref_names(self, devpaths: List[MKS.DevPath], all_revisions: List[MKS.Revision]):
+        """
+        Renames branches and tags that are invalid in git (--fix-ref-names)
+        """
+        tags = set([ tag for revision in all_revisions for tag in revision.tags ])
+        for type, items in [ ("Branch", devpaths), ("Tag", sorted(tags, key=lambda tag: tag.name)) ]:
+            for item in items:
+                fixed = Convert.fix_ref_name(item.git_name)
+                if fixed != item.git_name:
+                    Console.trace(f"{type} name '{item.git_name}' is renamed to '{fixed}'")
+                    item.git_name = fixed
+
+    def check_ref_names(self, devpaths: List[MKS.DevPath], all_revisions: List[MKS.Revision]):
+        """
+        Check the names of all branches and tags like git check-ref-format does, and whether they can be stored
+        next to each other as files (names that differ only in case, a name that is the directory of another name)
+        """
+        windows = platform.system() == 'Windows'
+        refs = { "refs/heads/main": ("Branch", "main") }    # full name of ref -> (type, name)
+        branches = {}                                       # branch -> [names of devpaths]
+        for devpath in devpaths:
+            branch = Convert.branch_name(devpath)
+            branches.setdefault(branch, []).append(devpath.name)
+            refs["refs/heads/" + branch] = ("Branch", devpath.git_name)
+        for tag in set([ tag.git_name for revision in all_revisions for tag in revision.tags ]):
+            refs["refs/tags/" + tag] = ("Tag", tag)
+
+        errors = 0
+        for branch, names in branches.items():
+            if len(names) > 1:
+                errors += 1
+                Console.error(f"Development paths {', '.join(names)} have the same branch name {branch}")
+        for ref, (type, name) in refs.items():
+            if Convert.invalid_ref_re.search(ref) or (windows and Convert.invalid_windows_ref_re.search(ref)):
+                errors += 1
+                Console.error(f"{type} name '{name}' is invalid: " + ", ".join(Convert.ref_name_errors(ref, windows)) +
+                              f" (--fix-ref-names renames it to '{Convert.fix_ref_name(name)}')")
+
+        case_sensitive = Convert.is_filesystem_case_sensitive()
+        keys = {}       # full name of ref, lower case if the file system is not case sensitive -> [full names of refs]
+        for ref in refs:
+            keys.setdefault(ref if case_sensitive else ref.lower(), []).append(ref)
+        for key, same in keys.items():
+            if len(same) > 1:
+                errors += 1
+                Console.error(f"{' and '.join(same)} differ only in case (see README)")
+            parts = key.split("/")
+            for i in range(3, len(parts)):
+                directory = "/".join(parts[:i])
+                if directory in keys:
+                    errors += 1
+                    Console.error(f"{keys[directory][0]} and {same[0]} cannot both exist, the first would be a directory of the second")
+        assert not errors, "Branch or tag names are incorrect"
+
+
+
+
+if args.metrics: Metrics.open(args.metrics)
+git = GitFastImport(os.path.abspath(os.path.join(".git", "integrity2git")), args.shared_store, read_only=args.verify)
 mks = MKS(args.pathToProject)
 convert = Convert(mks, git)
 
 
+metadata = MetadataCache(args.metadata_cache or os.path.join(git.state_dir, "metadata.sqlite"), mks)
+
 Console.trace("Retreiving master revisions")
-all_revisions = mks.retrieve_revisions()
+all_revisions = metadata.retrieve_revisions()
 revisions = all_revisions[:]
 
 Console.trace("Retreiving branches")
-devpaths = mks.retrieve_devpaths()
+devpaths = metadata.retrieve_devpaths()
 Console.trace("Retreiving branch revisions")
+metadata.retrieve_devpath_revisions(devpaths)
 for devpath in devpaths:
-    devpath.revisions = mks.retrieve_revisions(devpath)
     all_revisions.extend(devpath.revisions)
 
+revisions_by_number = {}
+for revision in all_revisions:
+    revisions_by_number.setdefault(revision.number, []).append(revision)
 for devpath in devpaths:
-    ancestors = [ r for r in all_revisions if r.number == devpath.ancestor ]
+    ancestors = revisions_by_number.get(devpath.ancestor, [])
     if len(ancestors) == 0: assert len(ancestors) == 1, f"Could not find ancestor revision {devpath.ancestor} for devpath {devpath.name}"
     assert len(ancestors) == 1, f"Multiple ancestor revisions found for devpath {devpath.name}: " + ", ".join([ a.number for a in ancestors ])
     devpath.ancestor = ancestors[0]
 
 Console.trace("Checking branch and tag names")
-convert.check_branch_tag_names([dp.git_name for dp in devpaths], "Branch")
-convert.check_tags_for_uniqueness(all_revisions)
-convert.check_branch_tag_names([t.git_name for rev in all_revisions for t in rev.tags ], "Tag")
+with Metrics.span("check ref names"):
+    if args.fix_ref_names: convert.fix_ref_names(devpaths, all_revisions)
+    convert.check_tags_for_uniqueness(all_revisions)
+    convert.check_ref_names(devpaths, all_revisions)
 
 
+if args.verify:
+    equal = convert.verify([ (revisions, None) ] + [ (devpath.revisions, devpath) for devpath in devpaths ])
+    convert.drop_sandboxes()
+    mks.session.close()
+    git.close()
+    Metrics.report()
+    exit(0 if equal else 1)
+
 Console.trace("Checking where to continue conversion")
 done_count = 0
 done_count, revisions = convert.find_continuation_point(done_count, revisions)
@@ -451,29 +2031,20 @@ for devpath in devpaths:
 Console.set_total_steps(len(all_revisions), done_count)
 Console.trace(f"Found {len(revisions)} revisions and {len(devpaths)} devpaths")
 if len(revisions) == 0 and sum([ len(dp.revisions) for dp in devpaths ]) == 0:
+    mks.session.close()
+    git.close()
     exit(0)
 
 convert.create_marks(revisions, devpaths)
 convert.repo = None # Close handle on git repository
 
-if not os.path.isdir(mks.sandboxPath):
-    # Create a build sandbox of the first revision
-    revision = None
-    if len(revisions) > 0:
-        revision = revisions[0]
-    else:
-        for devpath in devpaths:
-            if len(devpath.revisions) > 0:
-                revision = devpath.revisions[0]
-                break
-
-    mks.create_sandbox(revision)
-
-os.chdir(mks.sandboxPath)
-convert.export_to_git(revisions) # export master branch first
-
-for devpath in devpaths:
-    convert.export_to_git(devpath.revisions, devpath)
-os.chdir("..")
-
-mks.drop_sandbox()
+profile = cProfile.Profile() if args.profile else None
+if profile: profile.enable()
+convert.export_to_git([ (revisions, None) ] + [ (devpath.revisions, devpath) for devpath in devpaths ]) # export master branch first
+if profile:
+    profile.disable()
+    profile.dump_stats(args.profile)
+convert.drop_sandboxes()
+mks.session.close()
+git.close()
+Metrics.report()
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+"""
+Command server for the option --si-server of mks_checkpoints_to_git.py.
+It reads one si command line per line from stdin, runs it and writes its
+output to stdout, followed by a line with the terminator \x1e and the exit
+code of the command. It stops when stdin is closed.
+
+    mks_checkpoints_to_git.py --si-server "python si_command_server.py" ...
+
+The server starts si for each command, so it does not save the start-up time
+of si: it is only a reference for the protocol. A server that keeps a session
+open (e.g. with the Java API of Integrity) is not part of this project. The
+arguments are run once as si command before the first command,
+e.g. "connect --hostname=... --port=..." to open the connection only once.
+"""
+
+import os, sys, subprocess, shlex
+from command_line import split
+
+terminator = b"\x1e"
+# Encoding of the command lines, must be the --input-encoding of mks_checkpoints_to_git.py
+encoding = "cp850"
+
+
+def run(command: str, output) -> int:
+    """
+    Runs the command and copies its output to output
+    """
+    try:
+        process = subprocess.Popen(split(command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as ex:
+        output.write(("%s\n" % ex).encode(encoding))
+        return 127
+    for line in process.stdout:
+        output.write(line)
+    return process.wait()
+
+
+if len(sys.argv) > 1: # stderr is read as output, too, so the output would be taken for that of the first command
+    with open(os.devnull, 'wb') as devnull:
+        run(" ".join([ "si" ] + [ shlex.quote(arg) for arg in sys.argv[1:] ]), devnull)
+for line in sys.stdin.buffer:
+    command = line.decode(encoding).strip()
+    if not command: continue
+    exitcode = run(command, sys.stdout.buffer)
+    sys.stdout.buffer.write(terminator + b"%d\n" % exitcode)
+    sys.stdout.buffer.flush()
@@ -0,0 +1,172 @@
+import os, sys, json, subprocess, platform
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(root, "mks_checkpoints_to_git.py")
+fake_si = os.path.join(root, "bench", "fake_si.py")
+
+
+def small_project():
+    """
+    Three checkpoints on main, one development path with two checkpoints
+    """
+    revisions = [
+        { "number": "1.1", "parent": None, "devpath": None, "author": "anna", "seconds": 1500000000, "labels": [ "First" ],
+          "description": "Initial\nsecond line", "changes": { "a.txt": [1, 100], "src/b.c": [1, 2000], "src/c.h": [1, 0] } },
+        { "number": "1.2", "parent": "1.1", "devpath": None, "author": "bert", "seconds": 1500003600, "labels": [],
+          "description": "Change", "changes": { "a.txt": [2, 120] } },
+        { "number": "1.3", "parent": "1.2", "devpath": None, "author": "anna", "seconds": 1500007200, "labels": [ "Release_1" ],
+          "description": "Remove", "changes": { "src/c.h": None, "d/e.txt": [1, 50] } },
+        { "number": "1.2.1.1", "parent": "1.2", "devpath": "Fix 1", "author": "carl", "seconds": 1500010800, "labels": [],
+          "description": "Fix", "changes": { "src/b.c": [2, 2100] } },
+        { "number": "1.2.1.2", "parent": "1.2.1.1", "devpath": "Fix 1", "author": "carl", "seconds": 1500014400, "labels": [],
+          "description": "Fix again", "changes": { "a.txt": [3, 10] } },
+    ]
+    return { "project": "/fake/project.pj", "seed": 1, "revisions": revisions, "devpaths": [ { "name": "Fix 1", "ancestor": "1.2" } ] }
+
+def project_with_devpaths(count: int):
+    """
+    The small project with count further development paths of one checkpoint each
+    """
+    project = small_project()
+    for i in range(2, count + 2):
+        name = "Fix %d" % i
+        project["devpaths"].append({ "name": name, "ancestor": "1.%d" % (1 + i % 3) })
+        project["revisions"].append({ "number": "1.%d.%d.1" % (1 + i % 3, i), "parent": "1.%d" % (1 + i % 3), "devpath": name, "author": "dora",
+                                      "seconds": 1500020000 + i, "labels": [], "description": "Fix %d" % i, "changes": { "fix%d.txt" % i: [1, i] } })
+    return project
+
+def project_with_labels(labels):
+    """
+    The small project with the labels on its first checkpoint
+    """
+    project = small_project()
+    project["revisions"][0]["labels"] = labels
+    return project
+
+def project_with_shared_subproject():
+    """
+    The small project with the shared subproject /fake/lib/project.pj in lib, first at 1.1 and from 1.3 on at 1.2
+    """
+    project = small_project()
+    revisions = { r["number"]: r for r in project["revisions"] }
+    revisions["1.1"]["subprojects"] = { "lib": [ "/fake/lib/project.pj", "1.1" ] }
+    revisions["1.3"]["subprojects"] = { "lib": [ "/fake/lib/project.pj", "1.2" ] }
+    project["shared"] = { "/fake/lib/project.pj": { "project": "/fake/lib/project.pj", "seed": 2, "devpaths": [], "revisions": [
+        { "number": "1.1", "parent": None, "devpath": None, "author": "lena", "seconds": 1400000000, "labels": [],
+          "description": "Library", "changes": { "lib.c": [1, 300], "include/lib.h": [1, 40] } },
+        { "number": "1.2", "parent": "1.1", "devpath": None, "author": "lena", "seconds": 1400003600, "labels": [],
+          "description": "Library fix", "changes": { "lib.c": [2, 310] } } ] } }
+    return project
+
+def project_with_large_files():
+    """
+    The small project with src/b.c (2000 and 2100 bytes), a large file with blanks and glob characters in its path,
+    and a project .gitattributes
+    """
+    project = small_project()
+    revisions = { r["number"]: r for r in project["revisions"] }
+    revisions["1.1"]["changes"][".gitattributes"] = [1, 0]
+    revisions["1.3"]["changes"]["my dir/big [1].bin"] = [1, 1500]
+    return project
+
+def project_with_static_tree():
+    """
+    The small project with 20 files in lib/x/y/z, one of them changed in 1.4 and changed back in 1.5
+    """
+    project = small_project()
+    project["revisions"][0]["changes"].update({ "lib/x/y/z/f%d.c" % i: [1, 100 + i] for i in range(20) })
+    project["revisions"][3:3] = [
+        { "number": "1.4", "parent": "1.3", "devpath": None, "author": "anna", "seconds": 1500008000, "labels": [],
+          "description": "Change lib", "changes": { "lib/x/y/z/f0.c": [2, 90] } },
+        { "number": "1.5", "parent": "1.4", "devpath": None, "author": "anna", "seconds": 1500009000, "labels": [],
+          "description": "Revert lib", "changes": { "lib/x/y/z/f0.c": [1, 100] } } ]
+    return project
+
+def generated_project(directory, *arguments) -> dict:
+    """
+    A project of bench/generate_project.py with 20 checkpoints and three development paths
+    """
+    filename = os.path.join(str(directory), "generated.json")
+    subprocess.run([ sys.executable, os.path.join(root, "bench", "generate_project.py"), filename, "--project", "/fake/project.pj",
+                     "--checkpoints", "20", "--files", "40", "--churn", "0.2", "--devpaths", "3", "--devpath-checkpoints", "3" ] + list(arguments), check=True)
+    with open(filename) as f:
+        return json.load(f)
+
+
+class Conversion:
+    """
+    Runs mks_checkpoints_to_git.py in a new git repository against bench/fake_si.py
+    """
+    def __init__(self, directory, project: dict):
+        self.directory = str(directory)
+        self.repo = os.path.join(self.directory, "repo")
+        self.project_file = os.path.join(self.directory, "project.json")
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.project_file, "w") as f:
+            json.dump(project, f)
+        bin_dir = os.path.join(self.directory, "bin")
+        os.makedirs(bin_dir)
+        si = os.path.join(bin_dir, "si")
+        with open(si, "w") as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, fake_si))
+        os.chmod(si, 0o755)
+        self.env = dict(os.environ, FAKE_SI_PROJECT=self.project_file, PATH=bin_dir + os.pathsep + os.environ["PATH"])
+        os.makedirs(self.repo)
+        subprocess.run(["git", "init", "-q", "-b", "main"], cwd=self.repo, check=True)
+
+    def start(self, *arguments, **environment) -> subprocess.Popen:
+        return subprocess.Popen([ sys.executable, script, "/fake/project.pj", "--date-format", "%Y-%m-%d %H:%M:%S" ] + list(arguments),
+                                cwd=self.repo, env=dict(self.env, FAKE_SI_DATE_FORMAT="%Y-%m-%d %H:%M:%S", **environment),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def run(self, *arguments, timeout=120, **environment) -> subprocess.CompletedProcess:
+        with self.start(*arguments, **environment) as process:
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                raise
+        return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+    def git(self, *arguments) -> str:
+        return subprocess.check_output(["git"] + list(arguments), cwd=self.repo, universal_newlines=True)
+
+    def commit_count(self) -> int:
+        return int(self.git("rev-list", "--all", "--count"))
+
+    def calls(self):
+        """
+        Returns (mode, command) of all si calls so far
+        """
+        if not os.path.isfile(self.project_file + ".calls"): return []
+        return [ tuple(line.split()) for line in open(self.project_file + ".calls") ]
+
+
+def history(conversion):
+    """
+    Returns tree, parents, author, date and subject of all commits, sorted
+    """
+    return sorted(conversion.git("log", "--all", "--format=%T %P %an %at %s").splitlines())
+
+def counters(conversion, metrics: str) -> dict:
+    """
+    Returns the counters of the last summary in the metrics file (relative to the repository)
+    """
+    summaries = [ json.loads(line) for line in open(os.path.join(conversion.repo, metrics)) if '"summary"' in line ]
+    return summaries[-1]["counters"]
+
+
+windows = pytest.mark.skipif(platform.system() == 'Windows', reason="the fake si is started by a shell script")
+
+@pytest.fixture
+def make_conversion(tmp_path):
+    """
+    Returns a function that creates the Conversion of a project in a subdirectory of tmp_path
+    """
+    if platform.system() == 'Windows': pytest.skip("the fake si is started by a shell script")
+    return lambda project, name="": Conversion(tmp_path / name, project)
+
+@pytest.fixture
+def conversion(make_conversion):
+    return make_conversion(small_project())
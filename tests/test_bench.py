@@ -0,0 +1,16 @@
+import os, sys, json, subprocess
+from conftest import root, windows
+
+
+@windows
+def test_benchmark_of_generated_project(tmp_path):
+    project = str(tmp_path / "project.json")
+    subprocess.run([ sys.executable, os.path.join(root, "bench", "generate_project.py"), project, "--checkpoints", "8", "--files", "30",
+                     "--devpaths", "2", "--devpath-checkpoints", "2", "--churn", "0.2" ], check=True)
+    output = subprocess.check_output([ sys.executable, os.path.join(root, "bench", "benchmark.py"), project, "--json", "--", "--sandboxes", "2" ],
+                                     universal_newlines=True, timeout=300)
+    result = json.loads(output)
+    assert result["exitcode"] == 0
+    assert result["checkpoints"] == 12
+    assert result["mb_sent"] > 0
+    assert result["peak_rss_mb"] > 0
@@ -0,0 +1,76 @@
+import os, json
+import pytest
+from conftest import counters, small_project
+
+
+def project_with_big_file():
+    """
+    The small project with a file that is too large to be buffered before it is sent to git
+    """
+    project = small_project()
+    project["revisions"][0]["changes"]["big.bin"] = [1, 17*1024*1024]
+    return project
+
+def cached_member(conversion, size: int) -> str:
+    """
+    Returns the file of the member cache with the given size
+    """
+    directory = os.path.join(conversion.repo, ".git", "integrity2git", "members")
+    return next(os.path.join(directory, name) for name in os.listdir(directory) if name != "index" and os.path.getsize(os.path.join(directory, name)) == size)
+
+
+@pytest.mark.parametrize("project, path, size", [ (small_project, "src/b.c", 2000), (project_with_big_file, "big.bin", 17*1024*1024) ], ids=[ "buffered", "streamed" ])
+@pytest.mark.parametrize("change", [ "grows", "shrinks" ])
+def test_file_that_changes_its_size_aborts_the_export(make_conversion, project, path, size, change):
+    cached = make_conversion(project(), "cached")
+    result = cached.run("--member-mode")
+    assert result.returncode == 0, result.stdout + result.stderr
+    # a new repository that uses the member cache, whose size of the file is then wrong
+    conversion = make_conversion(project(), "changed")
+    os.makedirs(os.path.join(conversion.repo, ".git", "integrity2git"))
+    os.rename(os.path.join(cached.repo, ".git", "integrity2git", "members"), os.path.join(conversion.repo, ".git", "integrity2git", "members"))
+    with open(cached_member(conversion, size), "r+b") as f:
+        if change == "grows":
+            f.seek(0, os.SEEK_END)
+            f.write(b"x")
+        else:
+            f.truncate(size - 1)
+    result = conversion.run("--member-mode")
+    assert result.returncode != 0
+    assert "%s changed its size while being exported" % path in result.stderr
+    assert conversion.git("rev-list", "--all") == ""
+
+def test_changed_content_aborts_the_export(make_conversion):
+    cached = make_conversion(small_project(), "cached")
+    assert cached.run("--member-mode").returncode == 0
+    conversion = make_conversion(small_project(), "changed")
+    os.makedirs(os.path.join(conversion.repo, ".git", "integrity2git"))
+    os.rename(os.path.join(cached.repo, ".git", "integrity2git", "members"), os.path.join(conversion.repo, ".git", "integrity2git", "members"))
+    with open(cached_member(conversion, 2000), "r+b") as f:
+        data = f.read(1)
+        f.seek(0)
+        f.write(bytes([ data[0] ^ 1 ]))
+    result = conversion.run("--member-mode")
+    assert result.returncode != 0
+    assert "src/b.c changed while being exported" in result.stderr
+
+def test_restart_exports_only_the_changes_of_new_revisions(conversion):
+    assert conversion.run().returncode == 0
+    manifests = os.path.join(conversion.repo, ".git", "integrity2git", "manifests")
+    saved = { name: os.path.getmtime(os.path.join(manifests, name)) for name in os.listdir(manifests) }
+    assert sorted(saved) == [ "devpath", "main.json" ]
+    with open(conversion.project_file) as f:
+        project = json.load(f)
+    project["revisions"].append({ "number": "1.4", "parent": "1.3", "devpath": None, "author": "anna", "seconds": 1500020000,
+                                  "labels": [], "description": "After the restart", "changes": { "a.txt": [4, 130] } })
+    with open(conversion.project_file, "w") as f:
+        json.dump(project, f)
+    result = conversion.run("--metrics", "metrics.jsonl")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert counters(conversion, "metrics.jsonl")["files exported"] == 1
+    assert counters(conversion, "metrics.jsonl")["manifests saved"] == 1
+    assert os.path.getmtime(os.path.join(manifests, "main.json")) > saved["main.json"]
+    with open(os.path.join(manifests, "main.json")) as f:
+        assert json.load(f)["revision"] == "1.4"
+    assert conversion.git("diff", "--name-only", "main~1", "main").split() == [ "a.txt" ]
+    assert int(conversion.git("cat-file", "-s", "main:a.txt")) == 130
@@ -0,0 +1,59 @@
+import os, hashlib, subprocess
+import pytest
+from conftest import project_with_large_files
+
+
+def pointer(conversion, ref: str, path: str) -> dict:
+    lines = conversion.git("show", "%s:%s" % (ref, path)).splitlines()
+    assert lines[0] == "version https://git-lfs.github.com/spec/v1"
+    return dict(line.split(" ", 1) for line in lines[1:])
+
+def lfs_object(conversion, oid: str) -> bytes:
+    with open(os.path.join(conversion.repo, ".git", "lfs", "objects", oid[0:2], oid[2:4], oid), "rb") as f:
+        return f.read()
+
+@pytest.fixture
+def conversion(make_conversion):
+    return make_conversion(project_with_large_files())
+
+
+def test_large_and_matching_files_become_lfs_pointers(conversion):
+    result = conversion.run("--lfs-size", "0.001", "--lfs-pattern", "*.txt", "--lfs-pattern", "src/*.h")
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    for ref, path, size in [ ("main~2", "src/b.c", 2000), ("devpath/Fix_1", "src/b.c", 2100), ("main", "my dir/big [1].bin", 1500), ("main", "a.txt", 120) ]:
+        entry = pointer(conversion, ref, path)
+        assert entry["size"] == str(size)
+        content = lfs_object(conversion, entry["oid"][len("sha256:"):])
+        assert len(content) == size and "sha256:" + hashlib.sha256(content).hexdigest() == entry["oid"]
+        conversion.git("read-tree", ref) # check-attr --cached reads the .gitattributes of the index
+        assert conversion.git("check-attr", "--cached", "filter", "--", path).strip().endswith("filter: lfs")
+    assert conversion.git("show", "main:.gitattributes").startswith("*.txt filter=lfs diff=lfs merge=lfs -text\nsrc/*.h filter=lfs")
+    assert conversion.git("show", "main~2:src/c.h") == "" # empty files stay empty
+
+    objects = [ f for d, _, files in os.walk(os.path.join(conversion.repo, ".git", "lfs", "objects")) for f in files ]
+    assert len(objects) == 7 # b.c twice, big [1].bin, e.txt and a.txt three times, each content once
+
+def test_project_gitattributes_are_kept(make_conversion):
+    project = project_with_large_files()
+    project["revisions"][0]["changes"][".gitattributes"] = [1, 30]
+    conversion = make_conversion(project)
+    result = conversion.run("--lfs-pattern", "*.bin")
+    assert result.returncode == 0, result.stdout + result.stderr
+    attributes = subprocess.check_output(["git", "show", "main:.gitattributes"], cwd=conversion.repo)
+    assert len(attributes) > 30 and attributes.endswith(b"\n*.bin filter=lfs diff=lfs merge=lfs -text\n")
+
+def test_pointers_are_the_files_with_the_lfs_filter(make_conversion):
+    project = project_with_large_files()
+    project["revisions"][0]["changes"].update({ "src/sub/x.h": [1, 30], "src/sub/deep/y.c": [1, 40] })
+    conversion = make_conversion(project)
+    result = conversion.run("--lfs-pattern", "src/*.h", "--lfs-pattern", "src/**/y.c", "--lfs-pattern", "*.[b]in")
+    assert result.returncode == 0, result.stdout + result.stderr
+    conversion.git("read-tree", "main")
+    pointers = []
+    for line in conversion.git("ls-tree", "-r", "-l", "main").splitlines():
+        path = line.split("\t", 1)[1]
+        is_pointer = subprocess.check_output(["git", "show", "main:" + path], cwd=conversion.repo).startswith(b"version https://git-lfs.github.com/spec/v1\n")
+        assert is_pointer == conversion.git("check-attr", "--cached", "filter", "--", path).strip().endswith("filter: lfs"), path
+        if is_pointer: pointers.append(path)
+    assert sorted(pointers) == [ "my dir/big [1].bin", "src/sub/deep/y.c" ]
@@ -0,0 +1,75 @@
+import os, sys, json, shlex, subprocess
+import pytest
+from conftest import small_project, root, script
+
+projects = [ "/fake/a/project.pj", "/fake/b/project.pj", "/fake/c/project.pj" ]
+
+
+@pytest.fixture
+def batch(make_conversion):
+    project = small_project()
+    project["projects"] = projects
+    conversion = make_conversion(project)
+    with open(os.path.join(conversion.directory, "projects.txt"), "w") as f:
+        f.write("/fake/a/project.pj\tserver1\n/fake/b/project.pj\tserver1\n/fake/c/project.pj\tserver2\n")
+    return conversion
+
+def run_batch(batch, *arguments, **environment):
+    command = "%s %s --date-format \"%%Y-%%m-%%d %%H:%%M:%%S\"" % (shlex.quote(sys.executable), shlex.quote(script))
+    return subprocess.run([ sys.executable, os.path.join(root, "integrity2git_many.py"), "projects.txt", "--prefix", "/fake/",
+                            "--conversion-command", command, "--jobs", "2", "--jobs-per-server", "1" ] + list(arguments),
+                          cwd=batch.directory, env=dict(batch.env, FAKE_SI_DATE_FORMAT="%Y-%m-%d %H:%M:%S", **environment),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=300)
+
+
+def test_projects_are_converted_concurrently_per_server(batch):
+    result = run_batch(batch, FAKE_SI_LATENCY="createsandbox=0.5")
+    assert result.returncode == 0, result.stdout + result.stderr
+    state = json.load(open(os.path.join(batch.directory, "integrity2git_many.json")))
+    for project in projects:
+        assert state[project]["status"] == "done"
+        assert state[project]["converted"] == 5
+        assert os.path.isfile(state[project]["log"])
+        directory = os.path.join(batch.directory, project[len("/fake/"):])
+        assert subprocess.check_output(["git", "rev-list", "--all", "--count"], cwd=directory).strip() == b"5"
+    a, b = state["/fake/a/project.pj"], state["/fake/b/project.pj"]
+    first, second = sorted([ a, b ], key=lambda p: p["started"])
+    assert first["started"] + first["seconds"] <= second["started"] # same server
+    assert "3 of 3 projects done, 15 revisions" in result.stdout
+
+def test_finished_projects_are_skipped(batch):
+    assert run_batch(batch).returncode == 0
+    result = run_batch(batch)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "3 of 3 projects are done already" in result.stdout
+
+def test_shared_store_holds_identical_blobs_once(batch):
+    result = run_batch(batch, "--jobs", "1", "--shared-store", "shared.git")
+    assert result.returncode == 0, result.stdout + result.stderr
+    store = os.path.join(batch.directory, "shared.git")
+    index = open(os.path.join(store, "integrity2git", "blobs")).read().split()
+    assert len(index) == len(set(index)) == 7 # all projects have the same content
+    logs = [ open(os.path.join(batch.directory, "logs", project[len("/fake/"):-len("/project.pj")] + "_project.pj.log")).read() for project in projects ]
+    assert sorted([ "blobs sent: 7" in log for log in logs ]) == [ False, False, True ] # only the first project sent its blobs
+    for project in projects:
+        directory = os.path.join(batch.directory, project[len("/fake/"):])
+        subprocess.run(["git", "fsck", "--full", "--no-progress"], cwd=directory, check=True)
+        assert subprocess.check_output(["git", "rev-list", "--all", "--count"], cwd=directory).strip() == b"5"
+        objects = subprocess.check_output(["git", "count-objects", "-v"], cwd=directory)
+        assert b"count: 0" in objects and b"in-pack: 0" in objects # everything is in the store
+
+def test_largest_project_is_converted_first_on_the_first_run(batch):
+    with open(batch.project_file) as f:
+        project = json.load(f)
+    large = small_project()
+    large["project"] = "/fake/b/project.pj"
+    large["revisions"] += [ { "number": "1.%d" % i, "parent": "1.%d" % (i - 1), "devpath": None, "author": "anna", "seconds": 1500020000 + i,
+                              "labels": [], "description": "More", "changes": { "a.txt": [i, i] } } for i in range(4, 10) ]
+    project["shared"] = { "/fake/b/project.pj": large }
+    with open(batch.project_file, "w") as f:
+        json.dump(project, f)
+    result = run_batch(batch, "--jobs", "1")
+    assert result.returncode == 0, result.stdout + result.stderr
+    state = json.load(open(os.path.join(batch.directory, "integrity2git_many.json")))
+    assert min(state, key=lambda p: state[p]["started"]) == "/fake/b/project.pj"
+    assert state["/fake/b/project.pj"]["converted"] == 11
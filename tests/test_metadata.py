@@ -0,0 +1,35 @@
+import os
+import pytest
+from conftest import history, project_with_devpaths
+
+
+@pytest.fixture
+def conversions(make_conversion):
+    return [ make_conversion(project_with_devpaths(6), str(i)) for i in range(2) ]
+
+
+def test_devpath_histories_are_read_concurrently(conversions):
+    serial, concurrent = conversions
+    assert serial.run("--metadata-jobs", "1").returncode == 0
+    result = concurrent.run("--metadata-jobs", "4", FAKE_SI_LATENCY="viewprojecthistory=0.5")
+    assert result.returncode == 0, result.stderr
+    assert history(serial) == history(concurrent)
+    assert concurrent.git("branch", "--list", "devpath/*").count("devpath/") == 7
+
+def test_cached_history_is_used(conversions):
+    conversion = conversions[0]
+    assert conversion.run().returncode == 0
+    result = conversion.run("--cached-metadata")
+    assert result.returncode == 0, result.stderr
+    assert [ command for mode, command in conversion.calls() ].count("viewprojecthistory") == 8
+
+def test_descriptions_and_labels_survive_the_cache(conversions):
+    fresh, cached = conversions
+    metadata_cache = os.path.join(fresh.directory, "metadata.sqlite")
+    assert fresh.run("--metadata-cache", metadata_cache).returncode == 0
+    result = cached.run("--metadata-cache", metadata_cache, "--cached-metadata")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "viewprojecthistory" not in [ command for mode, command in cached.calls() ]
+    assert fresh.git("log", "-1", "--format=%B", "First") == cached.git("log", "-1", "--format=%B", "First") == "Initial\nsecond line\n"
+    assert history(fresh) == history(cached)
+    assert fresh.git("tag") == cached.git("tag") == "First\nRelease_1\n"
@@ -0,0 +1,18 @@
+import os, json, pstats
+
+
+def test_metrics_and_profile(conversion):
+    metrics = os.path.join(conversion.directory, "metrics.jsonl")
+    profile = os.path.join(conversion.directory, "export.prof")
+    result = conversion.run("--metrics", metrics, "--profile", profile, FAKE_SI_FAIL="projectinfo=1")
+    assert result.returncode == 0, result.stderr
+    assert "remaining" in result.stdout
+    records = [ json.loads(line) for line in open(metrics) ]
+    spans = [ r["name"] for r in records if r["type"] == "span" ]
+    assert "si viewprojecthistory" in spans and "retarget" in spans and "tree walk" in spans and "export revision" in spans
+    assert [ r["step"] for r in records if r["type"] == "step" ] == [ 1, 2, 3, 4, 5 ]
+    summary = records[-1]
+    assert summary["type"] == "summary"
+    assert summary["counters"]["si retries"] == 1
+    assert summary["counters"]["files exported"] > 0
+    assert pstats.Stats(profile).total_calls > 0
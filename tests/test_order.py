@@ -0,0 +1,30 @@
+import os
+import pytest
+from conftest import history, counters, generated_project
+
+
+@pytest.fixture
+def conversions(make_conversion, tmp_path):
+    project = generated_project(tmp_path)
+    return [ make_conversion(project, str(i)) for i in range(2) ]
+
+
+def test_depth_first_order_moves_the_sandbox_less(conversions):
+    branches, depth_first = conversions
+    assert branches.run("--metrics", "metrics.jsonl").returncode == 0
+    result = depth_first.run("--metrics", "metrics.jsonl", "--order", "depth-first")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert history(branches) == history(depth_first)
+    assert branches.git("show-ref") == depth_first.git("show-ref")
+    first, second = counters(branches, "metrics.jsonl"), counters(depth_first, "metrics.jsonl")
+    assert second["retarget distance"] < first["retarget distance"]
+    assert second["files changed in sandbox"] < first["files changed in sandbox"]
+    assert "Retarget distance: %d checkpoints instead of %d" % (second["retarget distance"], first["retarget distance"]) in result.stdout
+
+def test_only_changed_manifests_are_saved(conversions):
+    for conversion, order in zip(conversions, [ "branches", "depth-first" ]):
+        result = conversion.run("--metrics", "metrics.jsonl", "--checkpoint-every", "1", "--order", order)
+        assert result.returncode == 0, result.stdout + result.stderr
+        assert counters(conversion, "metrics.jsonl")["manifests saved"] == conversion.commit_count() # one manifest per commit
+        assert len(os.listdir(os.path.join(conversion.repo, ".git", "integrity2git", "manifests", "devpath"))) == 3
+    assert history(conversions[0]) == history(conversions[1])
@@ -0,0 +1,63 @@
+import os, json, random, subprocess
+from conftest import project_with_labels
+
+
+def git_accepts(ref: str) -> bool:
+    return subprocess.run(["git", "check-ref-format", ref]).returncode == 0
+
+def generated_names(count: int):
+    """
+    Random names from fragments that touch every rule of git check-ref-format (no ',', which separates labels)
+    """
+    fragments = [ "a", "B", "1", ".", "..", "/", "//", ".lock", "lock", "@", "{", "@{", "}", "-", "~", "^", ":", "?", "*",
+                  "[", "]", "\\", "\x01", "\x7f", "é", "con", "x.", "_" ]
+    rnd = random.Random(20)
+    return sorted(set("".join(rnd.choice(fragments) for _ in range(rnd.randint(1, 5))) for _ in range(count)))
+
+def messages(output: str, text: str):
+    """
+    Returns the names of the lines "Tag name '<name><text>..."
+    """
+    prefix = "Tag name '"
+    return [ line[len(prefix):line.rindex(text)] for line in output.splitlines() if line.startswith(prefix) and text in line ]
+
+
+def test_invalid_names_are_the_ones_git_rejects(conversion):
+    names = generated_names(1500)
+    with open(conversion.project_file, "w") as f:
+        json.dump(project_with_labels(names), f)
+    result = conversion.run("--input-encoding", "utf-8")
+    assert result.returncode != 0
+    assert sorted(messages(result.stderr, "' is invalid: ")) == sorted([ name for name in names if not git_accepts("refs/tags/" + name) ])
+
+    result = conversion.run("--input-encoding", "utf-8", "--fix-ref-names")
+    renamed = [ line[line.index("'") + 1:-1].split("' is renamed to '") for line in result.stdout.splitlines() if "' is renamed to '" in line ]
+    assert len(renamed) > 100
+    assert all(git_accepts("refs/tags/" + fixed) for _, fixed in renamed)
+    assert "is invalid" not in result.stderr
+
+def test_names_are_fixed(conversion):
+    with open(conversion.project_file, "w") as f:
+        json.dump(project_with_labels([ "First", "Release:2", "v1..2", ".hidden", "build.lock", "tail.", "@{u}", "back\\slash", "Fix/" ]), f)
+    result = conversion.run("--fix-ref-names")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert sorted(conversion.git("tag").split()) == sorted([ "@_u}", "First", "Fix", "Release_1", "Release_2", "_hidden", "back_slash", "build_lock", "tail_", "v1.2" ])
+
+def test_conflicting_names(conversion):
+    project = project_with_labels([ "v1", "v1/fix" ])
+    project["devpaths"].append({ "name": "Fix_1", "ancestor": "1.2" })
+    with open(conversion.project_file, "w") as f:
+        json.dump(project, f)
+    result = conversion.run()
+    assert result.returncode != 0
+    assert "Development paths Fix 1, Fix_1 have the same branch name devpath/Fix_1" in result.stderr
+    assert "refs/tags/v1 and refs/tags/v1/fix cannot both exist" in result.stderr
+
+def test_many_names_are_checked_fast(conversion):
+    metrics = os.path.join(conversion.directory, "metrics.jsonl")
+    with open(conversion.project_file, "w") as f:
+        json.dump(project_with_labels([ "Release_%d.%d/build-%d" % (i // 1000, i % 1000, i) for i in range(100000) ] + [ "invalid..name" ]), f)
+    result = conversion.run("--metrics", metrics)
+    assert result.returncode != 0 and "Tag name 'invalid..name' is invalid: Contains '..'" in result.stderr
+    spans = [ json.loads(line) for line in open(metrics) if '"check ref names"' in line ]
+    assert spans[0]["seconds"] < 1.0
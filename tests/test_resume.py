@@ -0,0 +1,71 @@
+import os, time, shutil
+import pytest
+from conftest import history, generated_project
+
+
+def state(conversion, name: str) -> str:
+    return os.path.join(conversion.repo, ".git", "integrity2git", name)
+
+def indexed(conversion) -> list:
+    if not os.path.isfile(state(conversion, "revisions")): return []
+    return open(state(conversion, "revisions")).read().splitlines()
+
+def interrupt(conversion, count: int, *arguments):
+    """
+    Kills the conversion as soon as count revisions are indexed, i.e. after a checkpoint and before the next one
+    """
+    process = conversion.start(*arguments, FAKE_SI_LATENCY="resync=0.2,projectco=0.05")
+    try:
+        while len(indexed(conversion)) < count:
+            assert process.poll() is None, "the conversion finished before it was interrupted"
+            time.sleep(0.02)
+    finally:
+        process.kill()
+        process.communicate()
+
+@pytest.fixture
+def conversions(make_conversion, tmp_path):
+    project = generated_project(tmp_path)
+    fresh = make_conversion(project, "fresh")
+    assert fresh.run().returncode == 0
+    return fresh, make_conversion(project, "interrupted")
+
+
+@pytest.mark.parametrize("checkpoint", [ ("--checkpoint-every", "3"), ("--checkpoint-size", "0") ])
+def test_interrupted_conversion_continues(conversions, checkpoint):
+    fresh, interrupted = conversions
+    interrupt(interrupted, 6, *checkpoint)
+    assert 6 <= len(indexed(interrupted)) < fresh.commit_count()
+    result = interrupted.run(*checkpoint)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert history(interrupted) == history(fresh)
+    assert interrupted.git("show-ref") == fresh.git("show-ref")
+    assert len(indexed(interrupted)) == fresh.commit_count()
+
+def test_interrupted_checkpoint_is_completed_from_the_journal(conversions):
+    fresh, interrupted = conversions
+    interrupt(interrupted, 6, "--checkpoint-every", "3")
+    # as if the conversion stopped after git fast-import persisted a checkpoint, before the revisions were indexed
+    marks = { sha: mark for mark, sha in (line.split() for line in open(state(interrupted, "marks"))) }
+    revisions = indexed(interrupted)
+    with open(state(interrupted, "revisions"), "w") as f:
+        f.write("".join([ line + "\n" for line in revisions[:-3] ]))
+    with open(state(interrupted, "revisions.pending"), "w") as f:
+        for line in revisions[-3:]:
+            number, sha = line.split()
+            f.write("%s %s\n" % (number, marks[sha]))
+    result = interrupted.run("--checkpoint-every", "3")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert not os.path.exists(state(interrupted, "revisions.pending"))
+    assert history(interrupted) == history(fresh)
+    assert sorted(indexed(interrupted)[:len(revisions)]) == sorted(revisions)
+
+def test_repository_of_an_older_version_continues(conversions):
+    fresh, interrupted = conversions
+    interrupt(interrupted, 6, "--checkpoint-every", "3")
+    shutil.rmtree(os.path.join(interrupted.repo, ".git", "integrity2git")) # older versions kept no state, not even an index
+    result = interrupted.run()
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Indexing the commits of an older conversion" in result.stdout
+    assert history(interrupted) == history(fresh)
+    assert interrupted.git("show-ref") == fresh.git("show-ref")
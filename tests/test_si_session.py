@@ -0,0 +1,70 @@
+import sys, shlex
+from conftest import root, fake_si
+
+
+def test_si_for_each_command(conversion):
+    result = conversion.run()
+    assert result.returncode == 0, result.stderr
+    assert conversion.commit_count() == 5
+    assert set(mode for mode, command in conversion.calls()) == { "process" }
+
+def test_failed_command_is_tried_again_with_growing_delay(conversion):
+    result = conversion.run(FAKE_SI_FAIL="projectinfo=2")
+    assert result.returncode == 0, result.stderr
+    assert "trying again in 1 s" in result.stderr
+    assert "trying again in 2 s" in result.stderr
+    assert [ command for mode, command in conversion.calls() ].count("projectinfo") == 3
+    assert conversion.commit_count() == 5
+
+def test_failed_command_gives_up_after_retries(conversion):
+    result = conversion.run("--si-retries", "2", FAKE_SI_FAIL="projectinfo=5")
+    assert result.returncode != 0
+    assert "Command failed" in result.stderr
+    assert [ command for mode, command in conversion.calls() ].count("projectinfo") == 2
+
+def test_hanging_command_times_out(conversion):
+    result = conversion.run("--si-timeout", "2", FAKE_SI_HANG="projectinfo=1")
+    assert result.returncode == 0, result.stderr
+    assert "Timeout after 2 seconds" in result.stderr
+    assert conversion.commit_count() == 5
+
+def test_command_server(conversion):
+    server = "%s %s --serve" % (shlex.quote(sys.executable), shlex.quote(fake_si))
+    result = conversion.run("--si-server", server)
+    assert result.returncode == 0, result.stderr
+    assert conversion.commit_count() == 5
+    assert set(mode for mode, command in conversion.calls()) == { "server" }
+
+def test_hanging_command_server_is_replaced(conversion):
+    server = "%s %s --serve" % (shlex.quote(sys.executable), shlex.quote(fake_si))
+    result = conversion.run("--si-server", server, "--si-timeout", "2", FAKE_SI_HANG="projectinfo=1")
+    assert result.returncode == 0, result.stderr
+    assert "Timeout after 2 seconds" in result.stderr
+    assert conversion.commit_count() == 5
+    assert set(mode for mode, command in conversion.calls()) == { "server" }
+
+def test_fallback_when_command_server_fails(conversion):
+    server = "%s -c pass" % shlex.quote(sys.executable) # exits at once
+    result = conversion.run("--si-server", server)
+    assert result.returncode == 0, result.stderr
+    assert "Starting si for each command from now on" in result.stderr
+    assert conversion.commit_count() == 5
+    assert set(mode for mode, command in conversion.calls()) == { "process" }
+
+def test_reference_command_server(conversion):
+    server = "%s %s connect" % (shlex.quote(sys.executable), shlex.quote(root + "/si_command_server.py"))
+    result = conversion.run("--si-server", server)
+    assert result.returncode == 0, result.stderr
+    assert conversion.commit_count() == 5
+    assert [ command for mode, command in conversion.calls() ][0] == "connect"
+
+def test_failed_command_reports_its_output(conversion):
+    result = conversion.run(FAKE_SI_FAIL="projectinfo=1")
+    assert result.returncode == 0, result.stderr
+    assert "Returned 1: Simulated failure of projectinfo" in result.stderr
+
+def test_failed_command_of_command_server_reports_its_output(conversion):
+    server = "%s %s --serve" % (shlex.quote(sys.executable), shlex.quote(fake_si))
+    result = conversion.run("--si-server", server, FAKE_SI_FAIL="projectinfo=1")
+    assert result.returncode == 0, result.stderr
+    assert "Returned 1: Simulated failure of projectinfo" in result.stderr
@@ -0,0 +1,67 @@
+import os, json, sqlite3, subprocess
+import pytest
+from conftest import project_with_shared_subproject
+
+
+def tree(conversion, ref: str):
+    return conversion.git("ls-tree", "-r", ref).splitlines()
+
+@pytest.fixture
+def conversions(make_conversion):
+    return [ make_conversion(project_with_shared_subproject(), str(i)) for i in range(2) ]
+
+
+def test_shared_subprojects_become_submodules(conversions):
+    conversion = conversions[0]
+    result = conversion.run("--submodules", "../submodules")
+    assert result.returncode == 0, result.stdout + result.stderr
+    lib = os.path.join(conversion.directory, "submodules", "fake_lib")
+    commits = dict(line.split() for line in open(os.path.join(lib, ".git", "integrity2git", "revisions")))
+    assert sorted(commits) == [ "1.1", "1.2" ]
+
+    assert "160000 commit %s\tlib" % commits["1.2"] in tree(conversion, "main")
+    assert "160000 commit %s\tlib" % commits["1.1"] in tree(conversion, "main~1")
+    assert "160000 commit %s\tlib" % commits["1.1"] in tree(conversion, "devpath/Fix_1")
+    assert not [ line for line in tree(conversion, "main") if line.endswith(("lib.c", "lib.h")) ]
+    assert conversion.git("show", "main:.gitmodules") == '[submodule "lib"]\n\tpath = lib\n\turl = %s\n' % lib
+
+    result = conversion.run("--submodules", "../submodules")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert subprocess.check_output(["git", "rev-list", "--all", "--count"], cwd=lib).strip() == b"2"
+    assert conversion.commit_count() == 5
+
+def test_member_mode_links_the_same_submodules(conversions):
+    sandbox, member = conversions
+    assert sandbox.run("--submodules", "../submodules").returncode == 0
+    result = member.run("--submodules", "../../0/submodules", "--member-mode") # the shared subproject is converted already
+    assert result.returncode == 0, result.stdout + result.stderr
+    for ref in [ "main", "main~1", "main~2", "devpath/Fix_1" ]:
+        assert tree(sandbox, ref) == tree(member, ref)
+
+def test_member_mode_tells_archives_apart(conversions):
+    sandbox, member = conversions
+    project = project_with_shared_subproject()
+    project["revisions"][2]["subprojects"] = { "lib": [ "/fake/lib2/project.pj", "1.1" ] } # same paths and member revisions
+    project["shared"]["/fake/lib2/project.pj"] = dict(project["shared"]["/fake/lib/project.pj"], project="/fake/lib2/project.pj", seed=3)
+    for conversion in conversions:
+        with open(conversion.project_file, "w") as f:
+            json.dump(project, f)
+    assert sandbox.run().returncode == 0
+    result = member.run("--member-mode")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert sandbox.git("rev-parse", "main:lib/lib.c") != sandbox.git("rev-parse", "main~1:lib/lib.c")
+    for ref in [ "main", "main~1", "main~2", "devpath/Fix_1" ]:
+        assert tree(sandbox, ref) == tree(member, ref)
+
+def test_relative_paths_are_passed_to_the_subproject_conversion(conversions):
+    conversion = conversions[0]
+    subprocess.run(["git", "init", "-q", "--bare", os.path.join(conversion.directory, "store.git")], check=True)
+    result = conversion.run("--submodules", "../submodules", "--shared-store", "../store.git", "--metadata-cache", "../metadata.sqlite",
+                            "--metrics", "../metrics.jsonl")
+    assert result.returncode == 0, result.stdout + result.stderr
+    lib = os.path.join(conversion.directory, "submodules", "fake_lib")
+    assert subprocess.check_output(["git", "rev-list", "--all", "--count"], cwd=lib).strip() == b"2"
+    with sqlite3.connect(os.path.join(conversion.directory, "metadata.sqlite")) as db:
+        assert sorted([ row[0] for row in db.execute("SELECT DISTINCT project FROM revisions") ]) == [ "/fake/lib/project.pj", "/fake/project.pj" ]
+    summaries = [ line for line in open(os.path.join(conversion.directory, "metrics.jsonl")) if '"summary"' in line ]
+    assert len(summaries) == 2 # of the subproject and of the project
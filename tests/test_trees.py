@@ -0,0 +1,35 @@
+import json
+import pytest
+from conftest import counters, project_with_static_tree
+
+
+@pytest.fixture
+def conversion(make_conversion):
+    return make_conversion(project_with_static_tree())
+
+
+def test_unchanged_directories_are_written_as_trees(conversion):
+    result = conversion.run("--metrics", "metrics.jsonl")
+    assert result.returncode == 0, result.stdout + result.stderr
+    # lib of the first commit of Fix 1, whose parent 1.2 has no manifest any more, and lib of 1.5, which is lib of 1.1
+    assert counters(conversion, "metrics.jsonl")["trees reused"] == 2
+    assert counters(conversion, "metrics.jsonl")["files exported"] == 23 + 1 + 1 + 1 + 0 + 3 + 1 # 1.1 to 1.5, then Fix 1
+    assert conversion.git("rev-parse", "main:lib") == conversion.git("rev-parse", "main~4:lib")
+    assert len(conversion.git("ls-tree", "-r", "devpath/Fix_1").splitlines()) == 23
+    result = conversion.run("--verify")
+    assert result.returncode == 0 and "All 7 revisions are equal" in result.stdout, result.stdout + result.stderr
+
+def test_known_trees_are_kept_across_runs(conversion):
+    assert conversion.run().returncode == 0
+    with open(conversion.project_file) as f:
+        project = json.load(f)
+    project["devpaths"].append({ "name": "Fix 2", "ancestor": "1.4" })
+    project["revisions"].append({ "number": "1.4.1.1", "parent": "1.4", "devpath": "Fix 2", "author": "carl", "seconds": 1500020000,
+                                  "labels": [], "description": "Same as 1.4", "changes": {} })
+    with open(conversion.project_file, "w") as f:
+        json.dump(project, f)
+    result = conversion.run("--metrics", "metrics.jsonl")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert counters(conversion, "metrics.jsonl")["trees reused"] == 1 # the root
+    assert counters(conversion, "metrics.jsonl")["files exported"] == 0
+    assert conversion.git("rev-parse", "devpath/Fix_2^{tree}") == conversion.git("rev-parse", "main~1^{tree}")
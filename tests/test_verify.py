@@ -0,0 +1,48 @@
+import json
+import pytest
+from conftest import project_with_shared_subproject
+
+
+@pytest.fixture
+def converted(conversion):
+    assert conversion.run().returncode == 0
+    return conversion
+
+def change_project(conversion, change):
+    with open(conversion.project_file) as f:
+        project = json.load(f)
+    change({ r["number"]: r for r in project["revisions"] })
+    with open(conversion.project_file, "w") as f:
+        json.dump(project, f)
+
+
+def test_converted_revisions_are_equal(converted):
+    result = converted.run("--verify")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "All 5 revisions are equal" in result.stdout
+    assert converted.commit_count() == 5
+
+def test_differences_are_reported_by_path(converted):
+    def change(revisions):
+        revisions["1.3"]["changes"]["d/e.txt"] = [2, 50]
+        revisions["1.2"]["changes"]["new.txt"] = [1, 5]
+    change_project(converted, change)
+    result = converted.run("--verify", "--sandboxes", "2")
+    assert result.returncode == 1
+    assert "4 of 5 revisions differ: 1.2, 1.3, 1.2.1.1, 1.2.1.2" in result.stderr
+    assert "Revision 1.3: d/e.txt differs" in result.stderr
+    assert "Revision 1.2.1.2: new.txt is missing in git" in result.stderr
+    assert "Revision 1.1: " not in result.stderr
+
+def test_sample_of_revisions(converted):
+    result = converted.run("--verify", "--verify-sample", "2", "--member-mode")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Verifying 2 revisions" in result.stdout
+
+def test_submodules_and_lfs_are_verified(make_conversion):
+    conversion = make_conversion(project_with_shared_subproject())
+    arguments = [ "--submodules", "../submodules", "--lfs-size", "0.001", "--lfs-pattern", "*.h" ]
+    assert conversion.run(*arguments).returncode == 0
+    result = conversion.run("--verify", *arguments)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "All 5 revisions are equal" in result.stdout